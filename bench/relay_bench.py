@@ -0,0 +1,562 @@
+"""
+Offline benchmark of the Intercom relay path
+
+Drives the Intercom cog with synthetic messages against a local stand-in for
+Discord's webhook endpoint, so no bot token or network access is needed.
+
+    python bench/relay_bench.py                       # every scenario
+    python bench/relay_bench.py fanout --peers 100    # a single scenario
+    python bench/relay_bench.py --latency 80 --rate-limit-every 20
+
+Each scenario runs in its own process, so its peak memory is its own.
+"""
+
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import discord  # pylint: disable=wrong-import-position
+import discord.http  # pylint: disable=wrong-import-position
+
+SCENARIOS = ("unlinked", "fanout", "attachments", "bans")
+TOKEN = "x" * 64
+# Delivery outcomes other than "sent", as counted by the cog, and the column they go in
+OUTCOMES = {"failed": "failed", "unhealthy": "failed", "interrupted": "failed",
+            "dropped": "dropped"}
+
+
+def json_response(body, status: int = 200, headers=None) -> web.Response:
+    """
+    A JSON response py-cord recognises, it only parses an exact "application/json"
+    content type and aiohttp's own json_response adds a charset to it
+    """
+    return web.Response(
+        body=json.dumps(body).encode(), status=status, headers=headers,
+        content_type="application/json",
+    )
+
+
+class FakeDiscord:
+    """
+    Local stand-in for the webhook execute endpoint and the attachment CDN
+    """
+
+    def __init__(self, latency: float, rate_limit_every: int):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.requests = 0
+        self.rate_limited = 0
+        # message number -> list of delivery times
+        self.deliveries = {}
+        self.port = None
+        self._runner = None
+
+    async def start(self):
+        """
+        Start the server on a free port
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/api/v10/webhooks/{webhook_id}/{token}", self.execute)
+        app.router.add_route(
+            "*", "/api/v10/webhooks/{webhook_id}/{token}/messages/{message_id}", self.message
+        )
+        app.router.add_get("/files/{size}", self.file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    async def stop(self):
+        """
+        Stop the server
+        """
+        await self._runner.cleanup()
+
+    def reset(self):
+        """
+        Get ready for a new scenario
+        """
+        self.deliveries.clear()
+
+    async def execute(self, request: web.Request):
+        """
+        Fake "execute webhook"
+        """
+        self.requests += 1
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+            payload = json.loads(form["payload_json"])
+        else:
+            payload = await request.json()
+        await asyncio.sleep(self.latency)
+
+        if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": 0.05, "global": False},
+                status=429,
+                headers={"Retry-After": "0.05"},
+            )
+
+        number = int(payload.get("content", "0").split()[-1])
+        self.deliveries.setdefault(number, []).append(time.monotonic())
+
+        # py-cord sends wait=1, other clients wait=true
+        if request.query.get("wait") in ("1", "true"):
+            return json_response(self._message(request, payload))
+        return web.Response(status=204)
+
+    async def message(self, request: web.Request):
+        """
+        Fake "edit/delete webhook message"
+        """
+        if request.method == "DELETE":
+            return web.Response(status=204)
+        return json_response(self._message(request, await request.json()))
+
+    async def file(self, request: web.Request):
+        """
+        Fake attachment download
+        """
+        return web.Response(body=b"\0" * int(request.match_info["size"]))
+
+    def _message(self, request: web.Request, payload: dict) -> dict:
+        webhook_id = request.match_info["webhook_id"]
+        return {
+            "id": str(10**17 + self.requests),
+            "type": 0,
+            "channel_id": webhook_id,
+            "webhook_id": webhook_id,
+            "content": payload.get("content", ""),
+            "author": {"id": webhook_id, "username": "bench", "discriminator": "0000",
+                       "avatar": None, "bot": True},
+            "attachments": [],
+            "embeds": [],
+            "mentions": [],
+            "mention_roles": [],
+            "mention_everyone": False,
+            "pinned": False,
+            "tts": False,
+            "timestamp": "2024-01-01T00:00:00+00:00",
+            "edited_timestamp": None,
+        }
+
+
+class FakeAttachment:
+    """
+    Just enough of discord.Attachment for the relay path
+    """
+
+    def __init__(self, base: str, size: int, number: int):
+        self.id = number
+        self.filename = f"bench_{number}.bin"
+        self.description = None
+        self.size = size
+        self.url = f"{base}/files/{size}"
+
+    def is_spoiler(self) -> bool:
+        """
+        Attachments are never spoilers here
+        """
+        return False
+
+    def to_dict(self) -> dict:
+        """
+        What the relay journal keeps of an attachment
+        """
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "url": self.url,
+            "proxy_url": self.url,
+        }
+
+    async def read(self) -> bytes:
+        """
+        Attachments are served by the fake CDN
+        """
+        return b"\0" * self.size
+
+
+def make_author(user_id: int):
+    """
+    A synthetic message author
+    """
+    avatar = SimpleNamespace(url=f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png")
+    return SimpleNamespace(
+        id=user_id,
+        name=f"user{user_id}",
+        display_name=f"user{user_id}",
+        global_name=None,
+        discriminator="0",
+        bot=False,
+        avatar=avatar,
+        default_avatar=avatar,
+        display_avatar=avatar,
+    )
+
+
+def make_message(number: int, channel, author, attachments=()):
+    """
+    A synthetic discord.Message
+    """
+    return SimpleNamespace(
+        id=10**17 + number,
+        content=f"bench message {number}",
+        author=author,
+        channel=channel,
+        guild=channel.guild,
+        webhook_id=None,
+        attachments=list(attachments),
+        embeds=[],
+        stickers=[],
+        reference=None,
+    )
+
+
+class World:
+    """
+    The fake guilds and channels the bot can "see"
+    """
+
+    def __init__(self):
+        self.guilds = {}
+        self.channels = {}
+        self.next_id = 10**17
+
+    def guild(self):
+        """
+        Make a new guild
+        """
+        self.next_id += 1
+        guild = SimpleNamespace(id=self.next_id, name=f"guild{self.next_id}", me=None)
+        self.guilds[guild.id] = guild
+        return guild
+
+    def channel(self, guild):
+        """
+        Make a new text channel in a guild
+        """
+        self.next_id += 1
+        channel = SimpleNamespace(
+            id=self.next_id, guild=guild, name=f"channel{self.next_id}",
+            type=discord.ChannelType.text,
+        )
+        self.channels[channel.id] = channel
+        return channel
+
+    def client(self):
+        """
+        A stand-in for the bot
+        """
+        async def wait_until_ready():
+            # Never ready, the background loops stay parked while the bench drives the cog
+            await asyncio.Event().wait()
+
+        return SimpleNamespace(
+            user=SimpleNamespace(id=1),
+            command_prefix="$linktool.",
+            guilds=list(self.guilds.values()),
+            get_channel=self.channels.get,
+            get_guild=self.guilds.get,
+            wait_until_ready=wait_until_ready,
+        )
+
+
+async def link(cog, source, target, sync_bans: bool = False):
+    """
+    Link two channels directly in the database and the link index
+    """
+    async with cog.database.transaction() as database:
+        await database.execute(
+            "INSERT INTO intercom (peer1, peer2, peer1_gid, peer2_gid, active, sync_bans)"
+            " VALUES (?, ?, ?, ?, 1, ?)",
+            (source.id, target.id, source.guild.id, target.guild.id, int(sync_bans)),
+        )
+        await database.execute(
+            "INSERT OR REPLACE INTO webhooks_urls VALUES (?, ?, ?)",
+            (
+                target.id,
+                f"https://discord.com/api/webhooks/{target.id}/{TOKEN}",
+                target.guild.id,
+            ),
+        )
+    cog.links.add((source.id, target.id, source.guild.id, target.guild.id, 1, sync_bans))
+    cog.channels.put(
+        target.id, target.guild.id, f"https://discord.com/api/webhooks/{target.id}/{TOKEN}"
+    )
+
+
+def build(name: str, args, fake: FakeDiscord):
+    """
+    Set up a scenario, get the world, the messages to send and how many deliveries to expect
+    """
+    world = World()
+    links = []
+    messages = []
+    base = f"http://127.0.0.1:{fake.port}"
+
+    if name == "unlinked":
+        guild = world.guild()
+        channels = [world.channel(guild) for _ in range(args.channels)]
+        for number in range(args.messages):
+            channel = channels[number % len(channels)]
+            messages.append(make_message(number, channel, make_author(number % 500)))
+        return world, links, messages, 0, None
+
+    if name == "fanout":
+        source = world.channel(world.guild())
+        for _ in range(args.peers):
+            links.append((source, world.channel(world.guild()), False))
+        for number in range(args.messages):
+            messages.append(make_message(number, source, make_author(number % 50)))
+        return world, links, messages, args.messages * args.peers, None
+
+    if name == "attachments":
+        source = world.channel(world.guild())
+        peers = min(args.peers, 5)
+        for _ in range(peers):
+            links.append((source, world.channel(world.guild()), False))
+        count = max(1, args.messages // 10)
+        for number in range(count):
+            files = [
+                FakeAttachment(base, args.attachment_size, number * 2 + index)
+                for index in range(2)
+            ]
+            messages.append(make_message(number, source, make_author(number % 50), files))
+        return world, links, messages, count * peers, None
+
+    # bans: every target enforces a large ban list, half the authors are banned
+    source = world.channel(world.guild())
+    peers = min(args.peers, 10)
+    targets = [world.channel(world.guild()) for _ in range(peers)]
+    for target in targets:
+        links.append((source, target, True))
+    banned = set(range(10**15, 10**15 + args.bans))
+    for number in range(args.messages):
+        user_id = (10**15 + number) if number % 2 else (10**16 + number)
+        messages.append(make_message(number, source, make_author(user_id)))
+    expected = sum(1 for number in range(args.messages) if number % 2 == 0) * peers
+
+    def seed(cog):
+        for target in targets:
+            cog.ban_cache.replace(target.guild.id, banned)
+
+    return world, links, messages, expected, seed
+
+
+def outcomes(metrics) -> dict:
+    """
+    Get the delivery outcome counters of the cog so far
+    """
+    counts = {"sent": metrics.MESSAGES_RELAYED.labels().value, "failed": 0.0, "dropped": 0.0,
+              "retried": metrics.DELIVERY_RETRIES.labels().value}
+    for reason, column in OUTCOMES.items():
+        counts[column] += metrics.MESSAGES_FAILED.labels(reason).value
+    return counts
+
+
+def percentile(values, fraction: float) -> float:
+    """
+    Get a percentile of a list of values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_scenario(name: str, args, fake: FakeDiscord) -> dict:
+    """
+    Run one scenario in a fresh runtime directory, get its results
+    """
+    # pylint: disable=import-outside-toplevel,import-error
+    import intercom
+    import metrics
+
+    world, links, messages, expected, seed = build(name, args, fake)
+    # Removed once the scenario is over, after leaving it
+    with tempfile.TemporaryDirectory(prefix=f"intercom_bench_{name}_") as workdir:
+        os.makedirs(os.path.join(workdir, "runtime"))
+        config = configparser.ConfigParser()
+        config["Intercom"] = {
+            "relay_concurrency": str(args.concurrency),
+            "webhook_rate": "100000",
+            "webhook_rate_period": "1",
+            "queue_depth": str(max(100, len(messages))),
+        }
+        with open(os.path.join(workdir, "runtime", "config.ini"), "w", encoding="utf-8") as file:
+            config.write(file)
+
+        previous = os.getcwd()
+        os.chdir(workdir)
+        try:
+            cog = intercom.Intercom(world.client())
+            for source, target, sync_bans in links:
+                await link(cog, source, target, sync_bans)
+            if seed is not None:
+                seed(cog)
+            fake.reset()
+            before = outcomes(metrics)
+
+            started = {}
+            start = time.monotonic()
+            tasks = []
+            for message in messages:
+                number = message.id - 10**17
+                started[number] = time.monotonic()
+                # The gateway dispatches every event as its own task
+                tasks.append(asyncio.ensure_future(cog.on_message(message)))
+            await asyncio.gather(*tasks)
+
+            # Done once the cog settled every delivery, whether the fake saw it or not
+            deadline = start + args.timeout
+            while True:
+                counts = outcomes(metrics)
+                settled = sum(counts[column] - before[column] for column in ("sent", "failed",
+                                                                             "dropped"))
+                if settled >= expected:
+                    break
+                if time.monotonic() >= deadline:
+                    print(f"  {name}: timed out waiting for deliveries", file=sys.stderr)
+                    break
+                await asyncio.sleep(0.01)
+            elapsed = time.monotonic() - start
+
+            latencies = [
+                delivered - started[number]
+                for number, times in fake.deliveries.items()
+                for delivered in times
+            ]
+            cog.cog_unload()
+            await asyncio.sleep(0.1)
+        finally:
+            os.chdir(previous)
+
+    return {
+        "scenario": name,
+        "messages": len(messages),
+        "expected": expected,
+        "received": len(latencies),
+        **{column: int(counts[column] - before[column]) for column in counts},
+        "rate_limited": fake.rate_limited,
+        "msgs_per_sec": len(messages) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": (statistics.fmean(latencies) * 1000) if latencies else 0.0,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+async def run_alone(name: str, args) -> dict:
+    """
+    Run one scenario against a fresh stand-in for Discord
+    """
+    fake = FakeDiscord(args.latency / 1000, args.rate_limit_every)
+    await fake.start()
+    # Send every webhook call to the local stand-in instead of discord.com
+    discord.http.Route.base = property(lambda _: f"http://127.0.0.1:{fake.port}/api/v10")
+    try:
+        return await run_scenario(name, args, fake)
+    finally:
+        await fake.stop()
+
+
+def run_child(name: str, args) -> dict:
+    """
+    Run one scenario in a child process, get its results
+    """
+    options = [
+        f"--{key.replace('_', '-')}={value}"
+        for key, value in vars(args).items()
+        if key not in ("scenarios", "child")
+    ]
+    child = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), name, *options, "--child"],
+        stdout=subprocess.PIPE, check=True, text=True,
+    )
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    """
+    Run the selected scenarios and print a report
+    """
+    if args.child:
+        print(json.dumps(asyncio.run(run_alone(args.scenarios[0], args))))
+        return
+
+    results = [run_child(name, args) for name in args.scenarios or SCENARIOS]
+
+    header = (
+        f"{'scenario':<12} {'msgs':>7} {'sent':>7} {'failed':>7} {'dropped':>7} "
+        f"{'retried':>7} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8} "
+        f"{'maxrss MB':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<12} {result['messages']:>7} {result['sent']:>7} "
+            f"{result['failed']:>7} {result['dropped']:>7} {result['retried']:>7} "
+            f"{result['msgs_per_sec']:>10.1f} {result['p50_ms']:>8.1f} "
+            f"{result['p99_ms']:>8.1f} {result['mean_ms']:>8.1f} {result['max_rss_mb']:>10.1f}"
+        )
+    rate_limited = sum(result["rate_limited"] for result in results)
+    if rate_limited:
+        print(f"\n{rate_limited} requests were answered with 429")
+
+    # The numbers mean nothing if the relays did not go through
+    broken = [
+        result["scenario"] for result in results
+        if result["failed"] or result["dropped"] or result["sent"] < result["expected"]
+    ]
+    if broken:
+        print(f"\nRelays failed or went missing in: {', '.join(broken)}", file=sys.stderr)
+        sys.exit(1)
+
+
+def parse_args():
+    """
+    Read the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("scenarios", nargs="*", choices=[*SCENARIOS, []], metavar="scenario",
+                        help=f"scenarios to run ({', '.join(SCENARIOS)}), default: all")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per scenario")
+    parser.add_argument("--channels", type=int, default=10000,
+                        help="unlinked channels the messages are spread over")
+    parser.add_argument("--peers", type=int, default=50, help="peers of the linked channel")
+    parser.add_argument("--bans", type=int, default=100000, help="bans per target guild")
+    parser.add_argument("--attachment-size", type=int, default=512 * 1024,
+                        help="size of each attachment, in bytes")
+    parser.add_argument("--latency", type=float, default=30.0,
+                        help="simulated webhook latency, in milliseconds")
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every Nth webhook call with a 429")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="[Intercom] relay_concurrency to run with")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="seconds to wait for the deliveries of a scenario")
+    # Set on the child process running a single scenario, which prints its results as JSON
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
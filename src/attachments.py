@@ -0,0 +1,95 @@
+"""
+Attachments downloaded once and re-uploaded to every relay target
+"""
+
+import asyncio
+import io
+import os
+import tempfile
+
+import aiohttp
+import discord
+
+
+class SharedAttachment:
+    """
+    An attachment held in memory (or spilled to disk) that hands out fresh discord.Files
+    """
+    __slots__ = ("filename", "spoiler", "description", "data", "path")
+
+    def __init__(self, attachment: discord.Attachment, data=None, path=None):
+        self.filename = attachment.filename
+        self.spoiler = attachment.is_spoiler()
+        self.description = attachment.description
+        self.data = data
+        self.path = path
+
+    def to_file(self) -> discord.File:
+        """
+        Build a discord.File for one send, each send consumes (and closes) its own
+        """
+        if self.path is not None:
+            source = self.path
+        else:
+            # BytesIO shares the bytes object until written to, so this is not a copy
+            source = io.BytesIO(self.data)
+        return discord.File(
+            source,
+            filename=self.filename,
+            spoiler=self.spoiler,
+            description=self.description,
+        )
+
+    def close(self):
+        """
+        Drop the buffer and remove the spilled file, if any
+        """
+        self.data = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+async def _spill(attachment: discord.Attachment, session: aiohttp.ClientSession) -> str:
+    fd, path = tempfile.mkstemp(prefix="intercom_")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(1 << 20):
+                    await asyncio.to_thread(file.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+async def download(
+    attachment: discord.Attachment, session: aiohttp.ClientSession, spill_size: int
+) -> SharedAttachment:
+    """
+    Fetch an attachment, streaming it to a temporary file if it is bigger than spill_size
+    """
+    if attachment.size > spill_size:
+        return SharedAttachment(attachment, path=await _spill(attachment, session))
+    return SharedAttachment(attachment, data=await attachment.read())
+
+
+async def download_all(attachments, session: aiohttp.ClientSession, spill_size: int) -> list:
+    """
+    Fetch every attachment of a message concurrently
+    """
+    results = await asyncio.gather(
+        *(download(attachment, session, spill_size) for attachment in attachments),
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for result in results:
+            if isinstance(result, SharedAttachment):
+                result.close()
+        raise errors[0]
+    return results
@@ -0,0 +1,136 @@
+"""
+Per-guild cache of banned user ids
+"""
+
+import time
+from array import array
+
+
+def pack(user_ids) -> bytes:
+    """
+    Encode a ban list as a sorted uint64 array
+    """
+    return array("Q", sorted(user_ids)).tobytes()
+
+
+def unpack(blob: bytes) -> set:
+    """
+    Decode a ban list encoded by pack()
+    """
+    user_ids = array("Q")
+    user_ids.frombytes(blob)
+    return set(user_ids)
+
+
+class BanCache:
+    """
+    Guild id -> set of banned user ids
+
+    A guild is "ready" once its full ban list has been fetched at least once,
+    until then it is "pending" and its set (if any) only holds the bans seen as events,
+    along with the users already checked one by one and found not banned.
+    """
+
+    def __init__(self):
+        self._bans = {}
+        # guild id -> user ids checked and not banned, only for pending guilds
+        self._cleared = {}
+        # guild id -> time of the last full sync, only for ready guilds
+        self._synced_at = {}
+        # guilds changed since the last save
+        self._dirty = set()
+
+    def is_ready(self, guild_id: int) -> bool:
+        """
+        Check if the cached ban list of a guild is complete and can be trusted
+        """
+        return guild_id in self._synced_at
+
+    def is_stale(self, guild_id: int, max_age: float) -> bool:
+        """
+        Check if the ban list of a guild was never synced or synced more than max_age ago
+        """
+        synced_at = self._synced_at.get(guild_id)
+        return synced_at is None or time.time() - synced_at > max_age
+
+    def is_banned(self, guild_id: int, user_id: int) -> bool:
+        """
+        Check if an user is in the cached ban list of a guild
+        """
+        bans = self._bans.get(guild_id)
+        return bans is not None and user_id in bans
+
+    def is_cleared(self, guild_id: int, user_id: int) -> bool:
+        """
+        Check if an user was already found not banned in a pending guild
+        """
+        cleared = self._cleared.get(guild_id)
+        return cleared is not None and user_id in cleared
+
+    def clear(self, guild_id: int, user_id: int):
+        """
+        Record that an user is not banned in a pending guild, until its full sync
+        """
+        if guild_id not in self._synced_at:
+            self._cleared.setdefault(guild_id, set()).add(user_id)
+
+    def replace(self, guild_id: int, user_ids):
+        """
+        Replace the whole ban list of a guild (full sync)
+        """
+        self._bans[guild_id] = set(user_ids)
+        self._synced_at[guild_id] = time.time()
+        self._cleared.pop(guild_id, None)
+        self._dirty.add(guild_id)
+
+    def add(self, guild_id: int, user_id: int):
+        """
+        Record a single ban
+        """
+        self._bans.setdefault(guild_id, set()).add(user_id)
+        cleared = self._cleared.get(guild_id)
+        if cleared is not None:
+            cleared.discard(user_id)
+        self._dirty.add(guild_id)
+
+    def discard(self, guild_id: int, user_id: int):
+        """
+        Record a single unban
+        """
+        bans = self._bans.get(guild_id)
+        if bans is not None:
+            bans.discard(user_id)
+            self._dirty.add(guild_id)
+
+    def forget(self, guild_id: int):
+        """
+        Drop everything known about a guild
+        """
+        self._bans.pop(guild_id, None)
+        self._synced_at.pop(guild_id, None)
+        self._cleared.pop(guild_id, None)
+        self._dirty.discard(guild_id)
+
+    def load(self, rows):
+        """
+        Restore ready guilds from (gid, updated_at, bans) snapshot rows
+        """
+        for guild_id, synced_at, blob in rows:
+            self._bans[guild_id] = unpack(blob)
+            self._synced_at[guild_id] = synced_at
+            self._cleared.pop(guild_id, None)
+
+    def take_dirty(self) -> list:
+        """
+        Get (gid, updated_at, bans) snapshot rows of the ready guilds changed since last call
+        """
+        rows = [
+            (guild_id, self._synced_at[guild_id], pack(self._bans[guild_id]))
+            for guild_id in self._dirty
+            if guild_id in self._synced_at
+        ]
+        self._dirty.clear()
+        return rows
+
+    def __contains__(self, guild_id):
+        return guild_id in self._bans
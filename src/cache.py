@@ -0,0 +1,52 @@
+"""
+Small in-process caches
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A dict that forgets its least recently used entries past maxsize
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Get an entry and mark it as recently used
+        """
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key, value):
+        """
+        Insert or replace an entry, evicting the oldest one if full
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry
+        """
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,68 @@
+"""
+Compact records of the channels taking part in links
+"""
+
+
+class LinkedChannel:
+    """
+    What the Cog keeps about one linked channel, the rest comes from the client cache
+    """
+    __slots__ = ("id", "guild_id", "webhook_url")
+
+    def __init__(self, channel_id: int, guild_id: int, webhook_url: str):
+        self.id = channel_id
+        self.guild_id = guild_id
+        self.webhook_url = webhook_url
+
+
+class ChannelCache:
+    """
+    Channel id -> LinkedChannel, kept in sync with the webhooks_urls table by the Cog
+
+    Only channels with a webhook (that is, taking part in a link) are kept,
+    so memory grows with the links rather than with every visible channel.
+    """
+
+    def __init__(self):
+        self._channels = {}
+
+    def load(self, rows):
+        """
+        Rebuild the cache from (id, gid, url) rows
+        """
+        self._channels.clear()
+        for channel_id, guild_id, webhook_url in rows:
+            self._channels[channel_id] = LinkedChannel(channel_id, guild_id, webhook_url)
+
+    def get(self, channel_id: int):
+        """
+        Get the record of a linked channel, None if it has no webhook
+        """
+        return self._channels.get(channel_id)
+
+    def put(self, channel_id: int, guild_id: int, webhook_url: str):
+        """
+        Record (or replace) the webhook of a channel
+        """
+        self._channels[channel_id] = LinkedChannel(channel_id, guild_id, webhook_url)
+
+    def pop(self, channel_id: int):
+        """
+        Forget a channel
+        """
+        return self._channels.pop(channel_id, None)
+
+    def drop_guild(self, guild_id: int):
+        """
+        Forget every channel of a guild
+        """
+        for channel_id in [
+            channel.id for channel in self._channels.values() if channel.guild_id == guild_id
+        ]:
+            del self._channels[channel_id]
+
+    def __contains__(self, channel_id):
+        return channel_id in self._channels
+
+    def __len__(self):
+        return len(self._channels)
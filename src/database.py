@@ -0,0 +1,202 @@
+"""
+The shared connection to the Intercom database
+"""
+
+import asyncio
+import contextlib
+import logging
+import sqlite3
+
+import aiosqlite
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _fix_column_drift(conn: sqlite3.Connection):
+    # Some databases lost (or never had) the sync_bans column and the old
+    # toggle_ban_sync wrote to a ban_sync column instead
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(intercom)")}
+    if "active" not in columns:
+        conn.execute("ALTER TABLE intercom ADD COLUMN active INTEGER DEFAULT 1")
+    if "sync_bans" not in columns:
+        conn.execute("ALTER TABLE intercom ADD COLUMN sync_bans INTEGER DEFAULT 1")
+        if "ban_sync" in columns:
+            conn.execute("UPDATE intercom SET sync_bans=ban_sync")
+
+
+# Each entry upgrades the database by one version (PRAGMA user_version),
+# databases created before versioning start at 0 and replay everything
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS intercom
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer1 INTEGER, peer2 INTEGER,
+    peer1_gid INTEGER, peer2_gid INTEGER,
+    active INTEGER DEFAULT 1,
+    sync_bans INTEGER DEFAULT 1);
+
+    CREATE TABLE IF NOT EXISTS webhooks_urls
+    (id INTEGER PRIMARY KEY, url TEXT, gid INTEGER);
+
+    CREATE TABLE IF NOT EXISTS silent_list
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gid INTEGER, silent_gid INTEGER);
+
+    CREATE TABLE IF NOT EXISTS fail2ban
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gid INTEGER, target_gid INTEGER,
+    count INTEGER DEFAULT 0);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ban_snapshots
+    (gid INTEGER PRIMARY KEY, updated_at REAL, bans BLOB);
+    """,
+    _fix_column_drift,
+    """
+    CREATE INDEX IF NOT EXISTS intercom_peer1 ON intercom (peer1, active);
+    CREATE INDEX IF NOT EXISTS intercom_peer2 ON intercom (peer2, active);
+    CREATE INDEX IF NOT EXISTS intercom_peer1_gid ON intercom (peer1_gid);
+    CREATE INDEX IF NOT EXISTS intercom_peer2_gid ON intercom (peer2_gid);
+    CREATE INDEX IF NOT EXISTS fail2ban_gids ON fail2ban (gid, target_gid);
+    CREATE INDEX IF NOT EXISTS silent_list_gids ON silent_list (gid, silent_gid);
+    CREATE INDEX IF NOT EXISTS webhooks_urls_gid ON webhooks_urls (gid);
+    """,
+    """
+    ALTER TABLE intercom ADD COLUMN coalesce_messages INTEGER DEFAULT 0;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS relay_payloads
+    (id TEXT PRIMARY KEY, source INTEGER, body TEXT, created_at REAL);
+
+    CREATE TABLE IF NOT EXISTS relay_journal
+    (payload TEXT, target INTEGER, guild INTEGER, attempts INTEGER DEFAULT 0,
+    PRIMARY KEY (payload, target));
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS relayed_messages
+    (source INTEGER, target INTEGER, message INTEGER,
+    PRIMARY KEY (source, target)) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS link_groups
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT, owner INTEGER, owner_gid INTEGER);
+
+    CREATE TABLE IF NOT EXISTS link_group_members
+    (group_id INTEGER, channel INTEGER, gid INTEGER,
+    sync_bans INTEGER DEFAULT 1,
+    PRIMARY KEY (group_id, channel));
+
+    CREATE INDEX IF NOT EXISTS link_group_members_channel ON link_group_members (channel);
+    CREATE INDEX IF NOT EXISTS link_group_members_gid ON link_group_members (gid);
+    """,
+]
+
+
+def migrate(path: str):
+    """
+    Bring the database at path up to the latest schema, one transaction per version
+
+    Safe to run from several processes sharing the database at once: each step
+    takes the write lock first and re-reads the version under it.
+    """
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.execute("COMMIT")
+                    break
+                step = MIGRATIONS[version]
+                logger.info("Migrating database to version %d", version + 1)
+                if callable(step):
+                    step(conn)
+                else:
+                    for statement in step.split(";"):
+                        if statement.strip():
+                            conn.execute(statement)
+                conn.execute(f"PRAGMA user_version={version + 1}")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+class Database:
+    """
+    One long-lived aiosqlite connection shared by every handler of the Cog
+
+    The connection runs in WAL mode so readers never wait on a writer, and keeps
+    a large statement cache so the handful of queries the Cog runs are only prepared once.
+    Writes must go through transaction() so two handlers never commit each other's work.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+
+    async def connect(self) -> aiosqlite.Connection:
+        """
+        Get the connection, opening it on first use
+        """
+        async with self._connect_lock:
+            if self._connection is None:
+                # Other processes may share the database, wait on their writes
+                connection = await aiosqlite.connect(
+                    self.path, cached_statements=256, timeout=30
+                )
+                await connection.execute("PRAGMA journal_mode=WAL")
+                await connection.execute("PRAGMA synchronous=NORMAL")
+                await connection.execute("PRAGMA temp_store=MEMORY")
+                self._connection = connection
+        return self._connection
+
+    async def close(self):
+        """
+        Close the connection
+        """
+        async with self._connect_lock:
+            if self._connection is not None:
+                await self._connection.close()
+                self._connection = None
+
+    async def fetchone(self, sql: str, parameters=()):
+        """
+        Run a query and get its first row
+        """
+        connection = await self.connect()
+        with metrics.DB_LOOKUP.time():
+            async with connection.execute(sql, parameters) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, parameters=()) -> list:
+        """
+        Run a query and get all of its rows
+        """
+        connection = await self.connect()
+        with metrics.DB_LOOKUP.time():
+            async with connection.execute(sql, parameters) as cursor:
+                return list(await cursor.fetchall())
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Borrow the connection for a group of writes, committed together on exit
+        """
+        async with self._write_lock:
+            connection = await self.connect()
+            try:
+                yield connection
+            except BaseException:
+                await connection.rollback()
+                raise
+            await connection.commit()
@@ -0,0 +1,314 @@
+"""
+Ordered, rate limited delivery of relayed messages to each target webhook
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+import aiohttp
+import discord
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Discord's limit on the content of a single message
+MAX_CONTENT = 2000
+
+
+class TokenBucket:
+    """
+    Allows rate requests per period, with bursts up to rate
+    """
+
+    def __init__(self, rate: int, period: float):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        """
+        Wait for a token and take it
+        """
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+    def block(self, seconds: float):
+        """
+        Hold every request back for a while, as told by a rate limit response
+        """
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Delivery:
+    """
+    One relayed message waiting to go out through one target webhook
+    """
+    __slots__ = (
+        "source_id", "target_id", "send", "release", "attempts",
+        "content", "merge_key", "hold_until", "received", "guild_id", "merged",
+        "update", "ready",
+    )
+
+    def __init__(self, source_id: int, target_id: int, send, release=None, **options):
+        self.source_id = source_id
+        self.target_id = target_id
+        # async callable doing the actual webhook call, given the content to post
+        self.send = send
+        # called exactly once with the outcome when the delivery leaves its queue
+        self.release = release
+        self.attempts = 0
+        self.content = options.get("content", "")
+        # text-only deliveries with the same merge key may be coalesced into one post
+        self.merge_key = options.get("merge_key")
+        self.hold_until = 0.0
+        # time.monotonic() of when the source message came in, for the latency metric
+        self.received = options.get("received")
+        # guild of the target, for the logs
+        self.guild_id = options.get("guild_id")
+        # deliveries coalesced into this one, they end the way it does
+        self.merged = []
+        # edits and deletions of earlier relays are not counted as relays
+        self.update = options.get("update", False)
+        # async callable awaited once before the first attempt, while the delivery holds
+        # its place in the queue; it is skipped if that returns False
+        self.ready = options.get("ready")
+
+    def finish(self, outcome: str, detail: str = ""):
+        """
+        Log and count the outcome ("sent", "coalesced", "skipped", "failed", "dropped" or
+        "interrupted"), then release whatever the delivery holds
+        """
+        latency = None if self.received is None else time.monotonic() - self.received
+        if outcome in ("sent", "coalesced", "skipped"):
+            # Hot path, skip building the record at all unless debug logs are on
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Relay %s", outcome, extra=self.log_fields(outcome, latency))
+        else:
+            logger.warning(
+                "Relay %s: %s", outcome, detail, extra=self.log_fields(outcome, latency)
+            )
+            metrics.MESSAGES_FAILED.labels(outcome).inc()
+        if outcome == "sent" and not self.update:
+            metrics.MESSAGES_RELAYED.inc()
+            if latency is not None:
+                metrics.RELAY_LATENCY.observe(latency)
+        if self.release is not None:
+            self.release(outcome)
+        for delivery in self.merged:
+            delivery.finish("coalesced" if outcome == "sent" else outcome, detail)
+
+
+    def log_fields(self, outcome: str, latency=None) -> dict:
+        """
+        Get the structured fields of a log record about this delivery
+        """
+        return {
+            "source": self.source_id,
+            "target": self.target_id,
+            "guild": self.guild_id,
+            "latency": None if latency is None else round(latency, 4),
+            "outcome": outcome,
+        }
+
+
+def _retry_after(exception: Exception):
+    """
+    Get how long Discord asked us to wait, if the error is a rate limit
+    """
+    response = getattr(exception, "response", None)
+    if getattr(exception, "status", None) != 429 or response is None:
+        return None
+    for header in ("Retry-After", "X-RateLimit-Reset-After"):
+        value = response.headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return 1.0
+
+
+def _is_retryable(exception: Exception) -> bool:
+    if isinstance(exception, (discord.NotFound, discord.Forbidden)):
+        return False
+    if isinstance(exception, discord.HTTPException):
+        return exception.status == 429 or exception.status >= 500
+    return isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+class TargetQueue:
+    """
+    FIFO of deliveries to one webhook, drained by a single worker so order is kept
+    """
+
+    def __init__(self, dispatcher, target_id: int):
+        self.dispatcher = dispatcher
+        self.target_id = target_id
+        self.bucket = TokenBucket(dispatcher.rate, dispatcher.period)
+        self.pending = collections.deque()
+        self.worker = None
+        self.send_time = metrics.WEBHOOK_SEND.labels(target_id)
+
+    def put(self, delivery: Delivery):
+        """
+        Queue a delivery, applying the drop policy if the queue is full
+        """
+        if self.coalesce(delivery):
+            return
+        if len(self.pending) >= self.dispatcher.depth:
+            if not self.dispatcher.drop_oldest:
+                delivery.finish("dropped", "queue full")
+                return
+            self.pending.popleft().finish("dropped", "queue full")
+        self.pending.append(delivery)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.drain())
+
+    def coalesce(self, delivery: Delivery) -> bool:
+        """
+        Merge a text-only delivery into the one waiting at the end of the queue, if possible
+        """
+        if delivery.merge_key is None:
+            return False
+        now = time.monotonic()
+        tail = self.pending[-1] if self.pending else None
+        if (
+            tail is not None
+            and tail.merge_key == delivery.merge_key
+            and now < tail.hold_until
+            and len(tail.content) + 1 + len(delivery.content) <= MAX_CONTENT
+        ):
+            # The hold is not extended, a burst waits one window from its first line at most
+            tail.content = f"{tail.content}\n{delivery.content}"
+            tail.merged.append(delivery)
+            return True
+        # Hold it back a little so the next lines of the same author can join it
+        delivery.hold_until = now + self.dispatcher.window
+        return False
+
+    async def drain(self):
+        """
+        Send every queued delivery in order, then exit
+        """
+        while self.pending:
+            # The head stays in the queue (open to merges) while it is held back
+            delay = self.pending[0].hold_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            delivery = self.pending.popleft()
+            try:
+                await self.run(delivery)
+            except asyncio.CancelledError:
+                delivery.finish("interrupted", "shutting down")
+                raise
+
+    async def run(self, delivery: Delivery):
+        """
+        Send one delivery, retrying it with backoff before moving to the next one
+        """
+        if delivery.ready is not None:
+            try:
+                if not await delivery.ready():
+                    delivery.finish("skipped")
+                    return
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                delivery.finish("failed", repr(exception))
+                return
+        while True:
+            await self.bucket.acquire()
+            try:
+                async with self.dispatcher.slots:
+                    with self.send_time.time():
+                        await delivery.send(delivery.content)
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                delivery.attempts += 1
+                if not _is_retryable(exception) or delivery.attempts > self.dispatcher.retries:
+                    delivery.finish("failed", repr(exception))
+                    return
+                metrics.DELIVERY_RETRIES.inc()
+                retry_after = _retry_after(exception)
+                if retry_after is not None:
+                    self.bucket.block(retry_after)
+                else:
+                    await asyncio.sleep(min(30.0, 2 ** delivery.attempts))
+                continue
+            delivery.finish("sent")
+            return
+
+    def close(self):
+        """
+        Stop the worker and release everything still queued
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+        while self.pending:
+            self.pending.popleft().finish("interrupted", "shutting down")
+
+
+class Dispatcher:
+    """
+    Routes deliveries to one queue per target webhook
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 8,
+        depth: int = 100,
+        drop_oldest: bool = True,
+        retries: int = 3,
+        rate: int = 5,
+        period: float = 2.0,
+        window: float = 0.75,
+    ):
+        # Caps how many webhook calls run at once across every queue
+        self.slots = asyncio.Semaphore(concurrency)
+        self.depth = depth
+        self.drop_oldest = drop_oldest
+        self.retries = retries
+        self.rate = rate
+        self.period = period
+        # How long (in seconds) a text-only delivery waits for more lines to coalesce
+        self.window = window
+        self.queues = {}
+
+    def submit(self, delivery: Delivery):
+        """
+        Queue a delivery behind the ones already going to the same target
+        """
+        queue = self.queues.get(delivery.target_id)
+        if queue is None:
+            queue = self.queues[delivery.target_id] = TargetQueue(self, delivery.target_id)
+        queue.put(delivery)
+
+    def forget(self, target_id: int):
+        """
+        Drop the queue of a target that went away
+        """
+        queue = self.queues.pop(target_id, None)
+        if queue is not None:
+            queue.close()
+
+    def close(self):
+        """
+        Stop every queue
+        """
+        for queue in self.queues.values():
+            queue.close()
+        self.queues.clear()
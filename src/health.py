@@ -0,0 +1,134 @@
+"""
+Health of the target webhooks: circuit breakers and deduplicated repairs
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookUnavailable(Exception):
+    """
+    Raised instead of calling a webhook whose circuit breaker is open
+    """
+
+
+class Breaker:
+    """
+    Consecutive failures of one target webhook, and until when it is skipped
+    """
+    __slots__ = ("failures", "open_until", "cooldown", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        # Half-open: the one call let through after the cooldown is still out
+        self.probing = False
+
+    def tripped(self, threshold: int) -> bool:
+        """
+        Check if the breaker has opened (whether or not its cooldown is over)
+        """
+        return self.failures >= threshold
+
+
+class WebhookHealth:
+    """
+    Channel id -> Breaker, plus the webhook repairs currently running
+
+    After threshold consecutive failures a target is skipped for cooldown seconds,
+    then a single call is let through (half-open) while the others are still skipped.
+    Each failure of that call doubles the cooldown, up to max_cooldown.
+    Any success closes the breaker again.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 60.0, max_cooldown: float = 3600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._breakers = {}
+        self._repairs = {}
+
+    def available(self, channel_id: int) -> bool:
+        """
+        Check if a call to a target could be allowed right now, without claiming it
+        """
+        breaker = self._breakers.get(channel_id)
+        if breaker is None or not breaker.tripped(self.threshold):
+            return True
+        return not breaker.probing and time.monotonic() >= breaker.open_until
+
+    def allow(self, channel_id: int) -> bool:
+        """
+        Claim a call to a target, it must be followed by succeeded(), failed() or abandon()
+
+        Once the cooldown of an open breaker is over, only the first caller gets through
+        until that call's outcome is known.
+        """
+        breaker = self._breakers.get(channel_id)
+        if breaker is None or not breaker.tripped(self.threshold):
+            return True
+        if breaker.probing or time.monotonic() < breaker.open_until:
+            return False
+        breaker.probing = True
+        return True
+
+    def succeeded(self, channel_id: int):
+        """
+        Record a successful call, closing the breaker of the target
+        """
+        if channel_id in self._breakers:
+            del self._breakers[channel_id]
+            logger.info("Webhook healthy again", extra={"target": channel_id})
+
+    def failed(self, channel_id: int):
+        """
+        Record a failed call, opening the breaker of the target past the threshold
+        """
+        breaker = self._breakers.get(channel_id)
+        if breaker is None:
+            breaker = self._breakers[channel_id] = Breaker()
+        breaker.failures += 1
+        breaker.probing = False
+        if not breaker.tripped(self.threshold):
+            return
+        breaker.cooldown = min(
+            self.max_cooldown, breaker.cooldown * 2 if breaker.cooldown else self.cooldown
+        )
+        breaker.open_until = time.monotonic() + breaker.cooldown
+        logger.warning(
+            "Webhook failed %d times in a row, skipping it for %.0f seconds",
+            breaker.failures, breaker.cooldown, extra={"target": channel_id},
+        )
+
+    def abandon(self, channel_id: int):
+        """
+        Record a call that ended without telling anything about the target (rate limited,
+        cancelled), letting the next one probe it instead
+        """
+        breaker = self._breakers.get(channel_id)
+        if breaker is not None:
+            breaker.probing = False
+
+    async def repair(self, channel_id: int, factory):
+        """
+        Run factory() to repair the webhook of a target, unless a repair of it is
+        already running, in which case wait for that one's result instead
+        """
+        task = self._repairs.get(channel_id)
+        if task is None:
+            task = self._repairs[channel_id] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._repairs.pop(channel_id, None))
+        return await asyncio.shield(task)
+
+    def forget(self, channel_id: int):
+        """
+        Drop the state of a target that went away
+        """
+        self._breakers.pop(channel_id, None)
+
+    def __len__(self):
+        return len(self._breakers)
@@ -3,98 +3,292 @@ The main Intercom module
 """
 
 import asyncio
-import os
-import random
+import collections
+import configparser
+import logging
 import sqlite3
-import string
+import time
 
 import aiohttp
-import aiosqlite
 import discord
 from discord.ext import commands, tasks
 
-
-class Intercom(commands.Cog):
+import metrics
+from bans import BanCache
+from cache import LRUCache
+from channels import ChannelCache
+from database import Database, migrate
+from delivery import Dispatcher
+from health import WebhookHealth
+from journal import RelayJournal
+from linking import LinkMixin
+from links import LinkIndex, Peer
+from relayed import RelayedMessages
+from relaying import RelayMixin
+from sharding import Handoff, ShardLayout
+
+logger = logging.getLogger(__name__)
+
+# The rows of the links, the link group members and the webhooks of the linked channels
+LINK_QUERIES = (
+    """
+    SELECT peer1, peer2, peer1_gid, peer2_gid, active, sync_bans, coalesce_messages
+    FROM intercom
+    """,
+    "SELECT group_id, channel, gid, sync_bans FROM link_group_members ORDER BY rowid",
+    """
+    SELECT id, gid, url FROM webhooks_urls
+    WHERE id IN (
+        SELECT peer1 FROM intercom UNION SELECT peer2 FROM intercom
+        UNION SELECT channel FROM link_group_members
+    )
+    """,
+)
+
+class Intercom(LinkMixin, RelayMixin, commands.Cog):
     """
     Intercom class
+
+    The link commands live in linking.py and the relay pipeline in relaying.py.
     """
-    ban_cache = {}
-    all_channels = []
 
     def __init__(self, client):
-        def setup_database():
-            if not os.path.exists("runtime/intercom.db"):
-                conn = sqlite3.connect("runtime/intercom.db")
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS intercom 
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                    peer1 INTEGER, peer2 INTEGER, 
-                    peer1_gid INTEGER, peer2_gid INTEGER, 
-                    active INTEGER DEFAULT 1,
-                    sync_bans INTEGER DEFAULT 1)
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS webhooks_urls 
-                    (id INTEGER PRIMARY KEY, url TEXT, gid INTEGER)
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS silent_list 
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                    gid INTEGER, silent_gid INTEGER)
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS fail2ban 
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                    gid INTEGER, target_gid INTEGER, 
-                    count INTEGER DEFAULT 0)
-                    """
-                )
-                conn.commit()
-                conn.close()
+        def load_links():
+            conn = sqlite3.connect("runtime/intercom.db")
+            self.apply_links(*(conn.execute(query).fetchall() for query in LINK_QUERIES))
+            conn.close()
+
+        def load_ban_snapshots():
+            conn = sqlite3.connect("runtime/intercom.db")
+            cursor = conn.cursor()
+            cursor.execute("SELECT gid, updated_at, bans FROM ban_snapshots")
+            self.ban_cache.load(cursor.fetchall())
+            conn.close()
+
+        def load_relayed():
+            conn = sqlite3.connect("runtime/intercom.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT source, target, message FROM relayed_messages
+                WHERE source >= ? ORDER BY source
+                """,
+                (self.relayed.cutoff(),),
+            )
+            self.relayed.load(cursor.fetchall())
+            conn.close()
 
         self.client = client
-        setup_database()
+        self.config = configparser.ConfigParser()
+        self.config.read("runtime/config.ini")
+        self.database = Database("runtime/intercom.db")
+        self.links = LinkIndex()
+        # Only the channels taking part in links, everything else comes from the client cache
+        self.channels = ChannelCache()
+        self.ban_cache = BanCache()
+        # One ordered, rate limited queue per target webhook
+        self.dispatcher = Dispatcher(
+            concurrency=self.config.getint("Intercom", "relay_concurrency", fallback=8),
+            depth=self.config.getint("Intercom", "queue_depth", fallback=100),
+            drop_oldest=self.config.get(
+                "Intercom", "queue_drop_policy", fallback="oldest"
+            ) == "oldest",
+            retries=self.config.getint("Intercom", "delivery_retries", fallback=3),
+            rate=self.config.getint("Intercom", "webhook_rate", fallback=5),
+            period=self.config.getfloat("Intercom", "webhook_rate_period", fallback=2.0),
+            window=self.config.getint("Intercom", "coalesce_window", fallback=750) / 1000,
+        )
+        # Long-lived HTTP session and the webhooks bound to it, keyed by channel id
+        self.session = None
+        self.webhooks = LRUCache(
+            self.config.getint("Intercom", "webhook_pool_size", fallback=256)
+        )
+        # User id -> {guild id: (username, avatar url)} relayed authors post as
+        self.identities = LRUCache(
+            self.config.getint("Intercom", "identity_cache_size", fallback=4096)
+        )
+        # Targets failing over and over are skipped for a while instead of called per message
+        self.health = WebhookHealth(
+            threshold=self.config.getint("Intercom", "webhook_failure_threshold", fallback=5),
+            cooldown=self.config.getfloat("Intercom", "webhook_cooldown", fallback=60.0),
+        )
+        # Relays still owed to their targets, replayed after failures and restarts
+        self.journal = RelayJournal(
+            self.config.getint("Intercom", "journal_max_attempts", fallback=5)
+        )
+        self.flush_journal.change_interval(  # pylint: disable=no-member
+            seconds=self.config.getint("Intercom", "journal_flush_interval", fallback=250) / 1000
+        )
+        self.replay_journal.change_interval(  # pylint: disable=no-member
+            seconds=self.config.getint("Intercom", "journal_replay_interval", fallback=60)
+        )
+        # Where the copies of recently relayed messages are, to relay edits and deletions
+        self.relayed = RelayedMessages(
+            maxsize=self.config.getint("Intercom", "relayed_max", fallback=100000),
+            ttl=self.config.getint("Intercom", "relayed_ttl", fallback=86400),
+            persist=self.config.getboolean("Intercom", "relayed_persist", fallback=False),
+        )
+        # How many guild ban lists are fetched at the same time during a sync
+        self.ban_sync_workers = self.config.getint(
+            "Intercom", "ban_sync_workers", fallback=4
+        )
+        # Ban lists synced longer ago than this (in seconds) get fetched again
+        self.ban_max_age = self.config.getint(
+            "Intercom", "ban_snapshot_max_age", fallback=86400
+        )
+        # Optional local /metrics endpoint, disabled unless [Metrics] port is set
+        self.metrics_server = None
+        if self.config.getint("Metrics", "port", fallback=0):
+            self.metrics_server = metrics.MetricsServer(
+                self.config.get("Metrics", "host", fallback="127.0.0.1"),
+                self.config.getint("Metrics", "port"),
+            )
+        # Attachments bigger than this (in bytes) are spilled to a temporary file
+        self.spill_size = self.config.getint(
+            "Intercom", "attachment_spill_size", fallback=8 * 1024 * 1024
+        )
+        # When running as several processes, each owning a range of shards,
+        # relays to guilds owned by another process are handed over to it
+        self.layout = None
+        self.handoff = None
+        # Handoffs still being sent, the event loop only keeps weak references to tasks
+        self.handoffs = set()
+        if (
+            self.config.getint("Sharding", "shard_count", fallback=0) > 0
+            and self.config.getint("Sharding", "process_count", fallback=1) > 1
+        ):
+            self.layout = ShardLayout(
+                self.config.getint("Sharding", "shard_count"),
+                self.config.getint("Sharding", "process_count"),
+                self.config.getint("Sharding", "process_index", fallback=0),
+            )
+            self.handoff = Handoff(
+                self.layout,
+                self.config.get("Sharding", "secret", fallback=""),
+                self.config.get("Sharding", "ipc_host", fallback="127.0.0.1"),
+                self.config.getint("Sharding", "ipc_port", fallback=7100),
+            )
+            self.handoff.on("relay", self.on_handoff_relay)
+            self.handoff.on("confirm", self.on_handoff_confirm)
+            self.handoff.on("links", self.on_handoff_links)
+            self.handoff.on("update", self.on_handoff_update)
+        migrate("runtime/intercom.db")
+        load_links()
+        load_ban_snapshots()
+        if self.relayed.persist:
+            load_relayed()
+
+        # The loops wait for the bot to be ready themselves
+        # pylint: disable=no-member
+        self.update_ban_cache.start()
+        self.save_ban_cache.start()
+        self.flush_journal.start()
+        self.replay_journal.start()
+        if self.relayed.persist:
+            self.save_relayed.start()
+        # pylint: enable=no-member
 
-    @tasks.loop(seconds=300)
-    async def update_channels(self):
+    def apply_links(self, links, members, channels):
         """
-        Update the list of channels the bot can see
+        Rebuild the link index and the linked channels from the rows of LINK_QUERIES
         """
-        print("Updating channels")
-        self.all_channels = list(self.client.get_all_channels())
-        print("Done")
+        self.links.load(links, members)
+        self.channels.load(channels)
 
-    @update_channels.before_loop
-    async def before_update_channels(self):
+    async def reload_links(self):
         """
-        Wait for the bot to be ready before updating channels
+        Reload the link index and the linked channels through the shared connection,
+        the old ones stay in use until every row is in
         """
-        await self.client.wait_until_ready()
+        self.apply_links(*[await self.database.fetchall(query) for query in LINK_QUERIES])
 
-    @tasks.loop(seconds=86400)
-    async def update_ban_cache(self):
+    async def links_changed(self):
         """
-        Task to update the ban cache
+        Tell the other processes (if any) to reload the links after a change
         """
-        print("Updating global ban cache")
-        guilds = self.client.guilds
-        for guild in guilds:
-            try:
-                self.ban_cache[guild.id] = [
-                    ban.user.id for ban in await guild.bans().flatten()
-                ]
-            except discord.errors.Forbidden:
-                print(f"Failed to get bans for {guild.name} ({guild.id})")
-                self.ban_cache[guild.id] = []
-        print("Done")
+        if self.handoff is not None:
+            await self.handoff.broadcast("links", {})
+
+    def cog_unload(self):
+        """
+        Stop the loops, save what is still in memory and release the HTTP session
+        and database when the cog goes away
+        """
+        # pylint: disable=no-member
+        self.update_ban_cache.cancel()
+        self.save_ban_cache.cancel()
+        self.flush_journal.cancel()
+        self.replay_journal.cancel()
+        self.save_relayed.cancel()
+        # pylint: enable=no-member
+        self.dispatcher.close()
+
+        conn = sqlite3.connect("runtime/intercom.db")
+        rows = self.ban_cache.take_dirty()
+        if rows:
+            conn.executemany("INSERT OR REPLACE INTO ban_snapshots VALUES (?, ?, ?)", rows)
+        rows = self.relayed.take_dirty()
+        if rows:
+            conn.executemany("INSERT OR REPLACE INTO relayed_messages VALUES (?, ?, ?)", rows)
+        # Interrupted deliveries are in the journal now, keep it for the next start
+        for statement, rows in self.journal.take_batch():
+            conn.executemany(statement, rows)
+        conn.commit()
+        conn.close()
+        self.webhooks.clear()
+        if self.session is not None and not self.session.closed:
+            asyncio.ensure_future(self.session.close())
+        asyncio.ensure_future(self.database.close())
+        if self.metrics_server is not None:
+            asyncio.ensure_future(self.metrics_server.stop())
+        if self.handoff is not None:
+            asyncio.ensure_future(self.handoff.stop())
+
+    @tasks.loop(seconds=3600)
+    async def update_ban_cache(self):
+        """
+        Task to resync stale ban lists, catching any drift from missed ban events
+        """
+        logger.info("Updating global ban cache")
+        # Snapshots restored from disk are trusted until they are older than ban_max_age
+        stale = [
+            guild
+            for guild in self.client.guilds
+            if self.ban_cache.is_stale(guild.id, self.ban_max_age)
+        ]
+        # Guilds that actually enforce synced bans go first
+        synced = self.links.ban_synced_guilds()
+        queue = collections.deque(
+            sorted(stale, key=lambda guild: guild.id not in synced)
+        )
+
+        async def worker():
+            while queue:
+                await self.refresh_bans(queue.popleft())
+
+        # The HTTP client waits out each bans bucket from its rate limit headers,
+        # so the pool only bounds how many guilds are in flight at once
+        await asyncio.gather(*(worker() for _ in range(self.ban_sync_workers)))
+        await self.save_ban_cache()
+        logger.info("Ban cache updated, %d guilds refreshed", len(stale))
+
+    async def refresh_bans(self, guild: discord.Guild):
+        """
+        Fetch the full ban list of a guild, marking its cache as ready
+        """
+        try:
+            self.ban_cache.replace(guild.id, {ban.user.id async for ban in guild.bans()})
+        except discord.errors.Forbidden:
+            logger.warning(
+                "No permission to get the bans of %s", guild.name, extra={"guild": guild.id}
+            )
+            self.ban_cache.replace(guild.id, ())
+        except discord.errors.HTTPException as exception:
+            # Stays pending, the next sync will try again
+            logger.warning(
+                "Failed to get the bans of %s: %s", guild.name, exception,
+                extra={"guild": guild.id},
+            )
 
     @update_ban_cache.before_loop
     async def before_update_ban_cache(self):
@@ -103,537 +297,241 @@ class Intercom(commands.Cog):
         """
         await self.client.wait_until_ready()
 
+    @tasks.loop(seconds=60)
+    async def save_ban_cache(self):
+        """
+        Task to write the ban lists changed since the last save to disk
+        """
+        rows = self.ban_cache.take_dirty()
+        if not rows:
+            return
+        async with self.database.transaction() as database:
+            await database.executemany(
+                "INSERT OR REPLACE INTO ban_snapshots VALUES (?, ?, ?)", rows
+            )
+
+    @save_ban_cache.before_loop
+    async def before_save_ban_cache(self):
+        """
+        Wait for the bot to be ready before saving the ban cache
+        """
+        await self.client.wait_until_ready()
+
     async def is_user_banned(self, guild_id: int, user: discord.User):
         """
         Helper function to check if an user is banned
         """
-        if guild_id in self.ban_cache:
-            return user.id in self.ban_cache[guild_id]
-        return False
-
-    @commands.command()
-    async def link(self, ctx: commands.Context, channel: int, sync_bans: bool = True):
-        """
-        Link two Discord Text channels together
-        """
-        if ctx.channel.permissions_for(ctx.author).manage_channels:
-            async with aiosqlite.connect("runtime/intercom.db") as database:
-                cursor = await database.cursor()
-
-                # Check if this set of channels is already linked (both ways)
-                check = await cursor.execute(
-                    "SELECT * FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
-                    (ctx.channel.id, channel, channel, ctx.channel.id),
-                )
-                check = await check.fetchone()
-                if check is not None:
-                    return await ctx.send("The target channel is already linked!")
-
-                target = discord.utils.find(
-                    lambda m: m.id == channel, self.all_channels
-                )
-
-                if target is None:
-                    return await ctx.send(
-                        str(
-                        "Invalid channel ID or this bot cannot see the target channel "
-                        "(If you just created the target channel, please wait about 5 minutes)!"
-                        )
-                    )
-
-                if target == ctx.channel:
-                    return await ctx.send("You can't link to yourself!")
-
-                if (
-                    ctx.channel.type != discord.ChannelType.text
-                    or target.type != discord.ChannelType.text
-                ):
-                    return await ctx.send("You can only link text channels!")
-
-                # Check if the target server silenced the initiating server
-                # or the initiator failed too many times
-                check = await cursor.execute(
-                    "SELECT * FROM silent_list WHERE gid=? AND silent_gid=?",
-                    (target.guild.id, ctx.guild.id),
-                )
-                check = await check.fetchone()
-                if check is not None:
-                    # Throw a dubious error message
-                    return await ctx.send("You can only link text channels!")
-
-                check = await cursor.execute(
-                    "SELECT * FROM fail2ban WHERE gid=? AND target_gid=?",
-                    (ctx.guild.id, target.guild.id),
-                )
-                check = await check.fetchone()
-                if check is not None:
-                    # If more than 3 fails, throw a dubious error message
-                    if check[3] >= 3:
-                        await ctx.send("You can only link text channels!")
-                        # ... and silent the initiating server from the target
-                        await cursor.execute(
-                            "INSERT INTO silent_list (gid, silent_gid) VALUES (?, ?)",
-                            (target.guild.id, ctx.guild.id),
-                        )
-                        # remove the counter
-                        await cursor.execute(
-                            "DELETE FROM fail2ban WHERE gid=? AND target_gid=?",
-                            (ctx.guild.id, target.guild.id),
-                        )
-                        await database.commit()
-
-                # Warn and disable sync_bans if we don't have the required permissions
-                if (
-                    not ctx.channel.permissions_for(ctx.guild.me).ban_members
-                    and sync_bans
-                ):
-                    sync_bans = False
-                    await ctx.send(
-                        str(
-                        "Since the Ban Members permission is not granted to the bridge "
-                        "(we need it to access the banned member list), "
-                        "we won't be able to sync bans! Proceed with caution!"
-                        )
-                    )
-
-                # Generate 6 random digits (prevents people from guessing the link)
-                random_string = "".join(random.choice(string.digits) for _ in range(6))
-
-                def verify_target(msg):
-                    return (
-                        msg.channel == target
-                        and msg.channel.permissions_for(msg.author).manage_channels
-                        and msg.content == random_string
-                    )
-
-                try:
-                    await ctx.send("Waiting for confirmation...")
-
-                    embed = discord.Embed(
-                        title="Linking request",
-                        description=str("There is a request to link to this channel "
-                           f"from #{ctx.channel.name} (server: {ctx.guild.name})"),
-                        color=0x00FF00,
-                    )
-                    embed.set_footer(
-                        text=f"Type {random_string} to confirm or wait 30 seconds to cancel"
-                    )
-                    await target.send(embed=embed)
-
-                    await self.client.wait_for(
-                        "message", check=verify_target, timeout=30
-                    )
-                except asyncio.TimeoutError:
-                    await target.send("Timeout!")
-                    # Add a fail counter or increment it
-                    check = await cursor.execute(
-                        "SELECT * FROM fail2ban WHERE gid=? AND target_gid=?",
-                        (ctx.guild.id, target.guild.id),
-                    )
-                    check = await check.fetchone()
-                    if check is None:
-                        await cursor.execute(
-                            "INSERT INTO fail2ban (gid, target_gid, count) VALUES (?, ?, 1)",
-                            (ctx.guild.id, target.guild.id),
-                        )
-                    else:
-                        await cursor.execute(
-                            "UPDATE fail2ban SET count=count+1 WHERE gid=? AND target_gid=?",
-                            (ctx.guild.id, target.guild.id),
-                        )
-                    await database.commit()
-                    return await ctx.send(
-                        "The other side did not confirm this activity"
-                    )
-
-                await ctx.send("Linking...")
-
-                # Clears any fail counter
-                await cursor.execute(
-                    "DELETE FROM fail2ban WHERE gid=? AND target_gid=?",
-                    (ctx.guild.id, target.guild.id),
-                )
-
-                source_wh = await cursor.execute(
-                    "SELECT * FROM webhooks_urls WHERE id=?", (ctx.channel.id,)
-                )
-                webhook_url = await source_wh.fetchone()
-
-                if webhook_url is None:
-                    webhook_url = await ctx.channel.create_webhook(
-                        name=f"Intercom_{ctx.channel.name}"
-                    )
-                    await cursor.execute(
-                        "INSERT INTO webhooks_urls VALUES (?, ?, ?)",
-                        (ctx.channel.id, webhook_url.url, ctx.channel.guild.id),
-                    )
-
-                target_wh = await cursor.execute(
-                    "SELECT * FROM webhooks_urls WHERE id=?", (target.id,)
-                )
-                webhook_url = await target_wh.fetchone()
-                if webhook_url is None:
-                    webhook_url = await target.create_webhook(
-                        name=f"Intercom_{target.name}"
-                    )
-                    await cursor.execute(
-                        "INSERT INTO webhooks_urls VALUES (?, ?, ?)",
-                        (target.id, webhook_url.url, ctx.channel.guild.id),
-                    )
-
-                await cursor.execute(
-                    """
-                    INSERT INTO intercom 
-                    (peer1, peer2, peer1_gid, peer2_gid, active, sync_bans) 
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        ctx.channel.id,
-                        channel,
-                        ctx.guild.id,
-                        target.guild.id,
-                        1,
-                        sync_bans,
-                    ),
-                )
-                await database.commit()
-                await ctx.send("Successfully linked!")
-                return await target.send(
-                    str(
-                    f"The channel {ctx.guild.name}/{ctx.channel.name} "
-                    "has been successfully linked with this channel!"
-                    )
-                )
-        else:
-            await ctx.send("You don't have permission to do that!")
-
-    @commands.command()
-    async def unlink(self, ctx: commands.Context, channel: int):
-        """
-        Unlink a channel from the current channel
-        """
-        unlink_candidate = []
-        if ctx.channel.permissions_for(ctx.author).manage_channels:
-            async with aiosqlite.connect("runtime/intercom.db") as database:
-                cursor = await database.cursor()
-                await cursor.execute(
-                    "SELECT * FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
-                    (ctx.channel.id, channel, channel, ctx.channel.id),
-                )
-                candidate = await cursor.fetchone()
-                if candidate is not None:
-                    unlink_candidate.append(candidate)
-
-                if len(unlink_candidate) == 0:
-                    return await ctx.send("You are not linked!")
-
-                await cursor.execute(
-                    "DELETE FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
-                    (ctx.channel.id, channel, channel, ctx.channel.id),
-                )
-                async with aiohttp.ClientSession() as session:
-                    for unlink in unlink_candidate:
-                        if unlink is None:
-                            continue
-                        target = discord.utils.find(
-                            lambda m: m.id == unlink[1], self.all_channels # pylint: disable=cell-var-from-loop
-                        )
-                        if target is None:
-                            continue
-                        target_wh = await cursor.execute(
-                            "SELECT * FROM webhooks_urls WHERE id=?", (target.id,)
-                        )
-                        webhook_url = await target_wh.fetchone()
-                        if webhook_url is None:
-                            continue
-                        webhook = discord.Webhook.from_url(
-                            webhook_url[1], session=session
-                        )
-                        await webhook.delete()
-                        await cursor.execute(
-                            "DELETE FROM webhooks_urls WHERE id=?", (target.id,)
-                        )
-                await database.commit()
-                await ctx.send("Successfully unlinked!")
-
-    @commands.command()
-    async def togglelink(self, ctx, channel: int):
-        """
-        Change the state of the link between channels (toggle active bit)
-        """
-        toggle_candidate = []
-        if ctx.channel.permissions_for(ctx.author).manage_channels:
-            async with aiosqlite.connect("runtime/intercom.db") as database:
-                cursor = await database.cursor()
-                await cursor.execute(
-                    "SELECT * FROM intercom WHERE peer1=? AND peer2=?",
-                    (ctx.channel.id, channel),
-                )
-                candidate = await cursor.fetchone()
-                if candidate is not None:
-                    toggle_candidate.append(candidate)
-                await cursor.execute(
-                    "SELECT * FROM intercom WHERE peer1=? AND peer2=?",
-                    (channel, ctx.channel.id),
-                )
-                candidate = await cursor.fetchone()
-                if candidate is not None:
-                    toggle_candidate.append(candidate)
-
-                if len(toggle_candidate) == 0:
-                    return await ctx.send("You are not linked!")
-
-                await cursor.execute(
-                    "UPDATE intercom SET active=? WHERE peer1=? AND peer2=?",
-                    (1 - toggle_candidate[0][5], ctx.channel.id, channel),
-                )
-                await cursor.execute(
-                    "UPDATE intercom SET active=? WHERE peer1=? AND peer2=?",
-                    (1 - toggle_candidate[0][5], channel, ctx.channel.id),
-                )
-                await database.commit()
-                await ctx.send("Successfully toggled!")
-
-    @commands.command()
-    async def listlinks(self, ctx):
-        """
-        List all the channels that are linked to this channel
-        """
-        async with aiosqlite.connect("runtime/intercom.db") as database:
-            cursor = await database.cursor()
-            await cursor.execute(
-                "SELECT peer1, peer2 FROM intercom WHERE peer1=? OR peer2=?",
-                (ctx.channel.id, ctx.channel.id),
-            )
-            result = await cursor.fetchall()
-            if len(result) == 0:
-                return await ctx.send("You are not linked!")
-
-            for row in result:
-                if row is None:
-                    continue
-                if row[0] == ctx.channel.id:
-                    source = ctx.channel
-                    channel_id = row[1]
-                    target = discord.utils.find(
-                        lambda m: m.id == channel_id, self.all_channels # pylint: disable=cell-var-from-loop
-                    )
-                    await ctx.send(
-                        f"`#{source.name}` ↔️ `#{target}` (`{target.id}@{target.guild.name}`)"
-                    )
-                else:
-                    source = ctx.channel
-                    target = discord.utils.find(
-                        lambda m: m.id == row[0], self.all_channels #pylint: disable=cell-var-from-loop
-                    )
-                    await ctx.send(
-                        f"`#{source.name}` ↔️ `#{target}` (`{target.id}-{target.guild.name}`)"
-                    )
-
-    @commands.command()
-    async def toggle_ban_sync(self, ctx):
-        """
-        Toggle the ban sync for this channel
-        """
-        if ctx.channel.permissions_for(ctx.author).manage_channels:
-            # Check if we have the Ban User permission (needed to sync bans)
-            if not ctx.channel.permissions_for(ctx.guild.me).ban_members:
-                return await ctx.send(
-                    "The Ban Members permission is necessary to access the ban list!"
-                )
-            async with aiosqlite.connect("runtime/intercom.db") as database:
-                cursor = await database.cursor()
-                await cursor.execute(
-                    "SELECT * FROM intercom WHERE peer1=? OR peer2=?",
-                    (ctx.channel.id, ctx.channel.id),
-                )
-                result = await cursor.fetchall()
-                if len(result) == 0:
-                    return await ctx.send("You are not linked!")
-
-                await cursor.execute(
-                    "UPDATE intercom SET ban_sync=? WHERE peer1=? OR peer2=?",
-                    (1 - result[0][6], ctx.channel.id, ctx.channel.id),
-                )
-                await database.commit()
-                await ctx.send("Successfully toggled!")
-
-    @commands.command()
-    async def toggle_silent(self, ctx, guild_id: int):
-        """
-        Disallow another server from sending link requests to this server
-        """
-        if ctx.channel.permissions_for(ctx.author).manage_channels:
-            async with aiosqlite.connect("runtime/intercom.db") as database:
-                cursor = await database.cursor()
-                await cursor.execute(
-                    "SELECT * FROM silent_list WHERE gid=? AND silent_gid=?",
-                    (ctx.guild.id, guild_id),
-                )
-                result = await cursor.fetchone()
-                if result is None:
-                    await cursor.execute(
-                        "INSERT INTO silent_list (gid, silent_gid) VALUES (?, ?)",
-                        (ctx.guild.id, guild_id),
-                    )
-                    await database.commit()
-                    await ctx.send(f"Successfully silenced `{guild_id}`!")
-                else:
-                    await cursor.execute(
-                        "DELETE FROM silent_list WHERE gid=? AND silent_gid=?",
-                        (ctx.guild.id, guild_id),
-                    )
-                    await database.commit()
-                    await ctx.send(f"Successfully unsilenced `{guild_id}`!")
+        if self.ban_cache.is_banned(guild_id, user.id):
+            return True
+        if self.ban_cache.is_ready(guild_id) or self.ban_cache.is_cleared(guild_id, user.id):
+            return False
+
+        # The ban list of this guild is still pending, ask Discord about this user only
+        guild = self.client.get_guild(guild_id)
+        if guild is None:
+            return False
+        try:
+            await guild.fetch_ban(user)
+        except discord.errors.HTTPException:
+            # Not banned (NotFound) or no way to tell, either way not asked again
+            # until the full ban list of the guild comes in
+            self.ban_cache.clear(guild_id, user.id)
+            return False
+        self.ban_cache.add(guild_id, user.id)
+        return True
 
     @commands.Cog.listener()
     async def on_ready(self):
         """
         Handle ready event
         """
-        # pylint: disable=no-member
-        self.update_channels.start()
-        self.update_ban_cache.start()
-        # pylint: enable=no-member
+        self.get_session()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.handoff is not None:
+            await self.handoff.start()
+
+    def split_peers(self, peers) -> tuple:
+        """
+        Get the local peers, and the other ones (as lists) by the process owning them
+        """
+        local = []
+        remote = collections.defaultdict(list)
+        for peer in peers:
+            if self.layout.is_local(peer.guild_id):
+                local.append(peer)
+            else:
+                remote[self.layout.process_of(peer.guild_id)].append(list(peer))
+        return tuple(local), remote
+
+    def hand_off(self, message: discord.Message, peers, username: str, avatar_url: str) -> tuple:
+        """
+        Send the peers owned by other processes over to them, get the local ones
+        """
+        local, remote = self.split_peers(peers)
+        for process, group in remote.items():
+            payload = {
+                "source": message.channel.id,
+                "message": message.id,
+                "peers": group,
+                "author": message.author.id,
+                "username": username,
+                "avatar_url": avatar_url,
+                "content": message.content,
+                "embeds": [embed.to_dict() for embed in message.embeds],
+                "attachments": [attachment.to_dict() for attachment in message.attachments],
+            }
+            self.spawn_handoff(process, payload)
+        return local
+
+    def spawn_handoff(self, process: int, payload: dict, kind: str = "relay"):
+        """
+        Run send_handoff() in the background, keeping a reference to it until it is done
+        """
+        task = asyncio.ensure_future(self.send_handoff(process, payload, kind))
+        self.handoffs.add(task)
+        task.add_done_callback(self.handoffs.discard)
+
+    async def send_handoff(self, process: int, payload: dict, kind: str = "relay"):
+        """
+        Hand a relay (or its update) over to another process,
+        counting it as failed if that process is gone
+        """
+        try:
+            await self.handoff.send(process, kind, payload)
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as exception:
+            logger.warning(
+                "Relay handoff to process %d failed: %r", process, exception,
+                extra={"source": payload["source"], "outcome": "failed"},
+            )
+            metrics.MESSAGES_FAILED.labels("failed").inc(len(payload["peers"]))
+
+    async def on_handoff_relay(self, payload: dict) -> dict:
+        """
+        Relay a message handed over by another process to the peers this process owns
+        """
+        received = time.monotonic()
+        peers = [Peer(*peer) for peer in payload["peers"]]
+        targets = self.resolve_targets(payload["source"], peers)
+        if len(targets) == 0:
+            return {}
+
+        state = self.client._connection  # pylint: disable=protected-access
+        self.relay(
+            payload["source"],
+            targets,
+            [discord.Attachment(data=data, state=state) for data in payload["attachments"]],
+            author=discord.Object(payload["author"]),
+            message_id=payload["message"],
+            author_id=payload["author"],
+            content=payload["content"],
+            embeds=[discord.Embed.from_dict(embed) for embed in payload["embeds"]],
+            username=payload["username"],
+            avatar_url=payload["avatar_url"],
+            received=received,
+        )
+        return {}
+
+    async def on_handoff_confirm(self, payload: dict) -> dict:
+        """
+        Wait for the confirmation code of a link requested from another process
+        """
+        def verify_target(msg):
+            return (
+                msg.channel.id == payload["channel"]
+                and msg.channel.permissions_for(msg.author).manage_channels
+                and msg.content == payload["code"]
+            )
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
+        try:
+            await self.client.wait_for(
+                "message", check=verify_target, timeout=payload["timeout"]
+            )
+        except asyncio.TimeoutError:
+            return {"confirmed": False}
+        return {"confirmed": True}
+
+    async def on_handoff_links(self, _payload: dict) -> dict:
         """
-        Handle messages
+        Reload the links changed by another process
         """
-        # Ignore: self, commands provided by self, bots,
-        # discord invites & gifts and webhooks
-        if (
-            message.author.bot
-            or message.author == self.client.user
-            or message.content.startswith(self.client.command_prefix)
-            or message.content.startswith("https://discord.gg/")
-            or message.content.startswith("https://discord.com/invite/")
-            or message.content.startswith("https://discordapp.com/invite/")
-            or message.content.startswith("https://discord.gift/")
-            or message.webhook_id is not None
-        ):
-            return
-        files = [await attachment.to_file() for attachment in message.attachments]
-        embeds = list(message.embeds)
+        await self.reload_links()
+        return {}
 
-        # Ignore message if EVERYTHING is empty at this point
-        # (we can't support everything, eg. Stickers)
-        if len(files) == 0 and len(embeds) == 0 and message.content == "":
-            return
-
-        # print(f"{message.channel.name}/{message.author.name}/{message.content}")
-        async with aiosqlite.connect("runtime/intercom.db") as database:
-            cursor = await database.cursor()
-            await cursor.execute(
-                "SELECT * FROM intercom WHERE (peer1=? AND active=1) OR (peer2=? AND active=1)",
-                (message.channel.id, message.channel.id),
-            )
-            targets = await cursor.fetchall()
-            if len(targets) == 0:
-                return
-
-            # print(targets)
-
-            async with aiohttp.ClientSession() as session:
-                for target in targets:
-                    # if the targets has sync_bans enabled,
-                    # check if the author is banned in the target channel
-                    target_cid = (
-                        target[1] if target[1] != message.channel.id else target[2]
-                    )
-                    target_gid = (
-                        target[3] if target[1] != message.channel.id else target[4]
-                    )
-
-                    if target[6] == 1:
-                        if await self.is_user_banned(target_gid, message.author):
-                            continue
-
-                    target = discord.utils.find(
-                        lambda m: m.id == target_cid, self.all_channels #pylint: disable=cell-var-from-loop``
-                    )
-                    webhook = ""
-                    rows = await cursor.execute(
-                        "SELECT url FROM webhooks_urls WHERE id=?", (target.id,)
-                    )
-                    row = await rows.fetchone()
-                    if row is None:
-                        webhook = await target.create_webhook(
-                            name=f"Intercom_{target.name}"
-                        )
-                        await cursor.execute(
-                            "INSERT INTO webhooks_urls VALUES (?, ?, ?)",
-                            (target.id, webhook.url, target.guild.id),
-                        )
-                        await database.commit()
-                        webhook = webhook.url
-                    else:
-                        webhook = row[0]
-
-                    # print(webhook)
-
-                    webhook = discord.Webhook.from_url(webhook, session=session)
-                    await webhook.send(
-                        content=message.content,
-                        files=files,
-                        embeds=embeds,
-                        avatar_url=message.author.avatar.url,
-                        username=f"{message.author.name} @ {message.guild.name}",
-                    )
+    async def on_handoff_update(self, payload: dict) -> dict:
+        """
+        Edit or delete the copies of a message relayed by this process for another one
+        """
+        self.update_relays(
+            payload["source"],
+            payload["message"],
+            payload["content"],
+            [Peer(*peer) for peer in payload["peers"]],
+        )
+        return {}
 
     @commands.Cog.listener()
-    async def on_guild_join(self):
+    async def on_guild_join(self, guild):
         """
-        Update the list of channels when the bot joins a new guild
+        Fetch the bans when the bot joins a new guild
         """
-        self.all_channels = list(self.client.get_all_channels())
+        await self.refresh_bans(guild)
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         """
-        Update the list of channels when a channel is deleted
+        Drop the links and webhook of a channel when it is deleted
         """
-        async with aiosqlite.connect("runtime/intercom.db") as database:
-            cursor = await database.cursor()
-            await cursor.execute(
+        async with self.database.transaction() as database:
+            await database.execute(
                 "DELETE FROM intercom WHERE peer1=? OR peer2=?",
                 (channel.id, channel.id),
             )
-            await cursor.execute("DELETE FROM webhooks_urls WHERE id=?", (channel.id,))
-            self.all_channels = list(self.client.get_all_channels())
-            await database.commit()
+            await database.execute(
+                "DELETE FROM link_group_members WHERE channel=?", (channel.id,)
+            )
+            await self.prune_groups(database)
+            await database.execute("DELETE FROM webhooks_urls WHERE id=?", (channel.id,))
+        self.links.drop_channel(channel.id)
+        self.channels.pop(channel.id)
+        self.webhooks.pop(channel.id)
+        self.health.forget(channel.id)
+        self.dispatcher.forget(channel.id)
+        await self.links_changed()
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         """
-        Update the list of channels when the bot leaves a guild
+        Drop everything known about a guild when the bot leaves it
         """
-        async with aiosqlite.connect("runtime/intercom.db") as database:
-            cursor = await database.cursor()
-            await cursor.execute(
+        async with self.database.transaction() as database:
+            await database.execute(
                 "DELETE FROM intercom WHERE peer1_gid=? OR peer2_gid=?",
                 (guild.id, guild.id),
             )
-            await cursor.execute("DELETE FROM webhooks_urls WHERE gid=?", (guild.id,))
-            self.all_channels = list(self.client.get_all_channels())
-            return await database.commit()
+            await database.execute("DELETE FROM link_group_members WHERE gid=?", (guild.id,))
+            await self.prune_groups(database)
+            await database.execute("DELETE FROM webhooks_urls WHERE gid=?", (guild.id,))
+            await database.execute("DELETE FROM ban_snapshots WHERE gid=?", (guild.id,))
+        self.links.drop_guild(guild.id)
+        self.channels.drop_guild(guild.id)
+        self.webhooks.clear()
+        self.ban_cache.forget(guild.id)
+        await self.links_changed()
 
     @commands.Cog.listener()
-    async def on_member_ban(self, guild):
+    async def on_member_ban(self, guild, user):
         """
         Hook the user banning event to update the ban cache for that guild
         """
-        # Update the ban cache for that guild
-        self.ban_cache[guild.id] = [ban.user.id for ban in await guild.bans().flatten()]
+        self.ban_cache.add(guild.id, user.id)
 
     @commands.Cog.listener()
-    async def on_member_unban(self, guild):
+    async def on_member_unban(self, guild, user):
         """
         Hook the user unbanning event to update the ban cache for that guild
         """
-        # Update the ban cache for that guild
-        self.ban_cache[guild.id] = [ban.user.id for ban in await guild.bans().flatten()]
+        self.ban_cache.discard(guild.id, user.id)
 
 
 def setup(client):
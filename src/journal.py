@@ -0,0 +1,176 @@
+"""
+Write-ahead journal of the relays still owed to their targets
+"""
+
+import json
+import time
+import uuid
+
+# Deletes the settled entries of a batch, its rows are their keys
+DELETE_ENTRIES = "DELETE FROM relay_journal WHERE payload=? AND target=?"
+
+
+class Payload:
+    """
+    What is needed to send a relayed message again, shared by all its targets
+    """
+    __slots__ = ("id", "source_id", "body", "persisted")
+
+    def __init__(self, payload_id: str, source_id: int, body: dict, persisted: bool = False):
+        self.id = payload_id
+        self.source_id = source_id
+        # content, embeds, attachments (as dicts), author_id, username and avatar_url
+        self.body = body
+        self.persisted = persisted
+
+
+class Entry:
+    """
+    One relay of a payload to one target channel
+    """
+    __slots__ = ("payload", "target_id", "guild_id", "attempts", "persisted")
+
+    def __init__(
+        self, payload: Payload, target_id: int, guild_id: int,
+        attempts: int = 0, persisted: bool = False,
+    ):
+        self.payload = payload
+        self.target_id = target_id
+        self.guild_id = guild_id
+        self.attempts = attempts
+        self.persisted = persisted
+
+    @property
+    def key(self) -> tuple:
+        """
+        Get the (payload id, target id) identifying the entry
+        """
+        return (self.payload.id, self.target_id)
+
+
+class RelayJournal:
+    """
+    Pending deliveries, written to the relay_journal table in batches
+
+    Recording and settling a delivery only touches memory, take_batch() gives what
+    changed since the last call so the Cog can group-commit it in one transaction.
+    A delivery settled before its entry ever reached the database costs no write at all.
+    """
+
+    def __init__(self, max_attempts: int = 5):
+        self.max_attempts = max_attempts
+        # Entries to insert or update on the next flush, by key
+        self._dirty = {}
+        # Keys of persisted entries to delete on the next flush
+        self._deleted = set()
+        # Keys of entries sitting in a delivery queue right now
+        self._live = set()
+        # Keys of settled entries still in the database until their deletion is committed
+        self._settled = set()
+
+    def record(self, source_id: int, body: dict, targets) -> list:
+        """
+        Journal a new message going to (target id, guild id) targets, get one entry per target
+        """
+        payload = Payload(uuid.uuid4().hex, source_id, body)
+        entries = [Entry(payload, target_id, guild_id) for target_id, guild_id in targets]
+        for entry in entries:
+            self._dirty[entry.key] = entry
+            self._live.add(entry.key)
+        return entries
+
+    def restore(self, rows) -> list:
+        """
+        Get the entries to replay from (payload, target, guild, attempts, source, body) rows,
+        skipping the ones still queued in this process and the ones already settled
+        """
+        payloads = {}
+        entries = []
+        for payload_id, target_id, guild_id, attempts, source_id, body in rows:
+            key = (payload_id, target_id)
+            if key in self._live or key in self._settled:
+                continue
+            payload = payloads.get(payload_id)
+            if payload is None:
+                payload = payloads[payload_id] = Payload(
+                    payload_id, source_id, json.loads(body), persisted=True
+                )
+            entry = Entry(payload, target_id, guild_id, attempts, persisted=True)
+            self._live.add(entry.key)
+            entries.append(entry)
+        return entries
+
+    def settle(self, entry: Entry, outcome: str):
+        """
+        Record how the delivery of an entry ended
+
+        Sent, coalesced, skipped and deliberately dropped deliveries leave the journal,
+        failed ones stay to be replayed until max_attempts, interrupted ones stay untouched.
+        """
+        self._live.discard(entry.key)
+        if outcome == "interrupted":
+            return
+        if outcome == "failed":
+            entry.attempts += 1
+            if entry.attempts < self.max_attempts:
+                self._dirty[entry.key] = entry
+                return
+        self.discard(entry)
+
+    def discard(self, entry: Entry):
+        """
+        Remove an entry from the journal without delivering it
+        """
+        self._live.discard(entry.key)
+        if entry.persisted:
+            self._deleted.add(entry.key)
+            self._settled.add(entry.key)
+        self._dirty.pop(entry.key, None)
+
+    def take_batch(self) -> list:
+        """
+        Get the (statement, rows) pairs writing the changes since the last call,
+        to be run in order within one transaction
+        """
+        payloads = []
+        entries = []
+        for entry in self._dirty.values():
+            if not entry.payload.persisted:
+                entry.payload.persisted = True
+                payloads.append(
+                    (entry.payload.id, entry.payload.source_id,
+                     json.dumps(entry.payload.body), time.time())
+                )
+            entry.persisted = True
+            entries.append((entry.payload.id, entry.target_id, entry.guild_id, entry.attempts))
+        deleted = list(self._deleted)
+        self._dirty = {}
+        self._deleted = set()
+
+        batch = []
+        if payloads:
+            batch.append(("INSERT OR IGNORE INTO relay_payloads VALUES (?, ?, ?, ?)", payloads))
+        if entries:
+            batch.append(("INSERT OR REPLACE INTO relay_journal VALUES (?, ?, ?, ?)", entries))
+        if deleted:
+            batch.append((DELETE_ENTRIES, deleted))
+            # A payload goes away with the last of its entries
+            batch.append((
+                """
+                DELETE FROM relay_payloads
+                WHERE id=? AND NOT EXISTS (SELECT 1 FROM relay_journal WHERE payload=?)
+                """,
+                list({(payload_id, payload_id) for payload_id, _ in deleted}),
+            ))
+        return batch
+
+    def committed(self, batch):
+        """
+        Forget the settled entries whose deletion was part of a batch now committed
+        """
+        for statement, rows in batch:
+            if statement == DELETE_ENTRIES:
+                self._settled.difference_update(rows)
+
+    def __len__(self):
+        return len(self._live)
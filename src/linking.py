@@ -0,0 +1,629 @@
+"""
+The commands managing the links and link groups of the Intercom
+"""
+
+import asyncio
+import random
+import string
+
+import discord
+from discord.ext import commands
+
+# Lines per listlinks embed, keeps a page well within the embed size limits
+LINKS_PER_PAGE = 20
+
+
+class LinkMixin:
+    """
+    Link and link group commands, mixed into the Intercom cog
+    """
+
+    @commands.command()
+    async def link(self, ctx: commands.Context, channel: int, sync_bans: bool = True):
+        """
+        Link two Discord Text channels together
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            # Check if this set of channels is already linked (both ways)
+            check = await self.database.fetchone(
+                "SELECT * FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
+                (ctx.channel.id, channel, channel, ctx.channel.id),
+            )
+            if check is not None:
+                return await ctx.send("The target channel is already linked!")
+
+            # The target may live on a shard owned by another process
+            target = await self.get_any_channel(channel)
+
+            if target is None:
+                return await ctx.send(
+                    "Invalid channel ID or this bot cannot see the target channel!"
+                )
+
+            if target == ctx.channel:
+                return await ctx.send("You can't link to yourself!")
+
+            if (
+                ctx.channel.type != discord.ChannelType.text
+                or target.type != discord.ChannelType.text
+            ):
+                return await ctx.send("You can only link text channels!")
+
+            if await self.silenced(ctx, target.guild.id):
+                # Throw a dubious error message
+                return await ctx.send("You can only link text channels!")
+
+            # Warn and disable sync_bans if we don't have the required permissions
+            if (
+                not ctx.channel.permissions_for(ctx.guild.me).ban_members
+                and sync_bans
+            ):
+                sync_bans = False
+                await ctx.send(
+                    str(
+                    "Since the Ban Members permission is not granted to the bridge "
+                    "(we need it to access the banned member list), "
+                    "we won't be able to sync bans! Proceed with caution!"
+                    )
+                )
+
+            await ctx.send("Waiting for confirmation...")
+            confirmed = await self.confirm(
+                ctx,
+                target,
+                "Linking request",
+                "There is a request to link to this channel "
+                f"from #{ctx.channel.name} (server: {ctx.guild.name})",
+            )
+            if not confirmed:
+                return await ctx.send(
+                    "The other side did not confirm this activity"
+                )
+
+            await ctx.send("Linking...")
+
+            # Create the missing webhooks first, so no API call happens mid-transaction
+            new_webhooks, peer_webhooks = await self.prepare_webhooks(ctx.channel, target)
+
+            async with self.database.transaction() as database:
+                # Clears any fail counter
+                await database.execute(
+                    "DELETE FROM fail2ban WHERE gid=? AND target_gid=?",
+                    (ctx.guild.id, target.guild.id),
+                )
+                await database.executemany(
+                    "INSERT INTO webhooks_urls VALUES (?, ?, ?)", new_webhooks
+                )
+                await database.execute(
+                    """
+                    INSERT INTO intercom
+                    (peer1, peer2, peer1_gid, peer2_gid, active, sync_bans)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        ctx.channel.id,
+                        channel,
+                        ctx.guild.id,
+                        target.guild.id,
+                        1,
+                        sync_bans,
+                    ),
+                )
+            self.links.add(
+                (ctx.channel.id, channel, ctx.guild.id, target.guild.id, 1, sync_bans)
+            )
+            for peer, url in peer_webhooks:
+                self.channels.put(peer.id, peer.guild.id, url)
+            await self.links_changed()
+            await ctx.send("Successfully linked!")
+            return await target.send(
+                str(
+                f"The channel {ctx.guild.name}/{ctx.channel.name} "
+                "has been successfully linked with this channel!"
+                )
+            )
+        else:
+            await ctx.send("You don't have permission to do that!")
+
+    async def confirm(self, ctx: commands.Context, target, title: str, description: str) -> bool:
+        """
+        Ask the target channel to confirm a request by typing a random code,
+        counting a failure against the requesting server if nobody does within 30 seconds
+        """
+        # Generate 6 random digits (prevents people from guessing the link)
+        random_string = "".join(random.choice(string.digits) for _ in range(6))
+
+        def verify_target(msg):
+            return (
+                msg.channel == target
+                and msg.channel.permissions_for(msg.author).manage_channels
+                and msg.content == random_string
+            )
+
+        try:
+            embed = discord.Embed(title=title, description=description, color=0x00FF00)
+            embed.set_footer(
+                text=f"Type {random_string} to confirm or wait 30 seconds to cancel"
+            )
+            await target.send(embed=embed)
+
+            if self.layout is None or self.layout.is_local(target.guild.id):
+                await self.client.wait_for(
+                    "message", check=verify_target, timeout=30
+                )
+            else:
+                # Only the process owning the target sees its messages
+                answer = await self.handoff.send(
+                    self.layout.process_of(target.guild.id),
+                    "confirm",
+                    {"channel": target.id, "code": random_string, "timeout": 30},
+                    timeout=35,
+                )
+                if not answer.get("confirmed"):
+                    raise asyncio.TimeoutError
+        except asyncio.TimeoutError:
+            await target.send("Timeout!")
+            # Add a fail counter or increment it
+            async with self.database.transaction() as database:
+                cursor = await database.execute(
+                    "UPDATE fail2ban SET count=count+1 WHERE gid=? AND target_gid=?",
+                    (ctx.guild.id, target.guild.id),
+                )
+                if cursor.rowcount == 0:
+                    await database.execute(
+                        "INSERT INTO fail2ban (gid, target_gid, count) VALUES (?, ?, 1)",
+                        (ctx.guild.id, target.guild.id),
+                    )
+            return False
+        return True
+
+    async def silenced(self, ctx: commands.Context, target_gid: int) -> bool:
+        """
+        Check if the target server silenced the initiating server
+        or the initiator failed too many times (silencing it then)
+        """
+        check = await self.database.fetchone(
+            "SELECT * FROM silent_list WHERE gid=? AND silent_gid=?",
+            (target_gid, ctx.guild.id),
+        )
+        if check is not None:
+            return True
+
+        check = await self.database.fetchone(
+            "SELECT * FROM fail2ban WHERE gid=? AND target_gid=?",
+            (ctx.guild.id, target_gid),
+        )
+        # Up to 3 fails are let through
+        if check is None or check[3] < 3:
+            return False
+        async with self.database.transaction() as database:
+            # ... past that, silent the initiating server from the target
+            await database.execute(
+                "INSERT INTO silent_list (gid, silent_gid) VALUES (?, ?)",
+                (target_gid, ctx.guild.id),
+            )
+            # remove the counter
+            await database.execute(
+                "DELETE FROM fail2ban WHERE gid=? AND target_gid=?",
+                (ctx.guild.id, target_gid),
+            )
+        return True
+
+    async def prepare_webhooks(self, *peers) -> tuple:
+        """
+        Create the webhooks the channels are missing, get the webhooks_urls rows to
+        insert and the (channel, url) pairs of every channel
+        """
+        new_webhooks = []
+        peer_webhooks = []
+        for peer in peers:
+            known = await self.database.fetchone(
+                "SELECT url FROM webhooks_urls WHERE id=?", (peer.id,)
+            )
+            if known is None:
+                webhook = await peer.create_webhook(name=f"Intercom_{peer.name}")
+                new_webhooks.append((peer.id, webhook.url, peer.guild.id))
+                peer_webhooks.append((peer, webhook.url))
+            else:
+                peer_webhooks.append((peer, known[0]))
+        return new_webhooks, peer_webhooks
+
+    async def prune_groups(self, database):
+        """
+        Within a transaction, drop the groups left without members and hand each group
+        whose owner left over to the member that joined first
+        """
+        await database.execute(
+            "DELETE FROM link_groups WHERE id NOT IN (SELECT group_id FROM link_group_members)"
+        )
+        # Members are only ever inserted, so their rowids follow the order they joined in
+        await database.execute(
+            """
+            UPDATE link_groups SET (owner, owner_gid) = (
+                SELECT channel, gid FROM link_group_members
+                WHERE group_id = link_groups.id ORDER BY rowid LIMIT 1
+            )
+            WHERE owner NOT IN (
+                SELECT channel FROM link_group_members WHERE group_id = link_groups.id
+            )
+            """
+        )
+
+    async def get_any_channel(self, channel_id: int):
+        """
+        Get a channel from the cache, or from Discord if it may be on another process' shards
+        """
+        channel = self.client.get_channel(channel_id)
+        if channel is None and self.layout is not None:
+            try:
+                channel = await self.client.fetch_channel(channel_id)
+            except discord.errors.HTTPException:
+                channel = None
+        return channel
+
+    @commands.command()
+    async def creategroup(self, ctx: commands.Context, name: str = None, sync_bans: bool = True):
+        """
+        Create a link group, other channels joining it are all linked together
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            if ctx.channel.type != discord.ChannelType.text:
+                return await ctx.send("You can only link text channels!")
+
+            if not ctx.channel.permissions_for(ctx.guild.me).ban_members and sync_bans:
+                sync_bans = False
+                await ctx.send(
+                    "Since the Ban Members permission is not granted to the bridge, "
+                    "we won't be able to sync bans! Proceed with caution!"
+                )
+
+            new_webhooks, peer_webhooks = await self.prepare_webhooks(ctx.channel)
+            async with self.database.transaction() as database:
+                await database.executemany(
+                    "INSERT INTO webhooks_urls VALUES (?, ?, ?)", new_webhooks
+                )
+                cursor = await database.execute(
+                    "INSERT INTO link_groups (name, owner, owner_gid) VALUES (?, ?, ?)",
+                    (name or ctx.channel.name, ctx.channel.id, ctx.guild.id),
+                )
+                group_id = cursor.lastrowid
+                await database.execute(
+                    "INSERT INTO link_group_members VALUES (?, ?, ?, ?)",
+                    (group_id, ctx.channel.id, ctx.guild.id, sync_bans),
+                )
+            self.links.add_member(group_id, ctx.channel.id, ctx.guild.id, sync_bans)
+            for peer, url in peer_webhooks:
+                self.channels.put(peer.id, peer.guild.id, url)
+            await self.links_changed()
+            await ctx.send(
+                f"Created link group `{group_id}`! "
+                f"Other channels can join it with `$linktool.joingroup {group_id}`"
+            )
+        else:
+            await ctx.send("You don't have permission to do that!")
+
+    @commands.command()
+    async def joingroup(self, ctx: commands.Context, group_id: int, sync_bans: bool = True):
+        """
+        Join a link group, once the channel that created it confirms
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            group = await self.database.fetchone(
+                "SELECT name, owner, owner_gid FROM link_groups WHERE id=?", (group_id,)
+            )
+            if group is None:
+                return await ctx.send("There is no such link group!")
+            if group_id in self.links.groups_of(ctx.channel.id):
+                return await ctx.send("This channel is already in that group!")
+            if ctx.channel.type != discord.ChannelType.text:
+                return await ctx.send("You can only link text channels!")
+
+            owner = await self.get_any_channel(group[1])
+            if owner is None:
+                return await ctx.send("The bot cannot see the channel owning that group!")
+
+            if await self.silenced(ctx, group[2]):
+                # Throw a dubious error message
+                return await ctx.send("You can only link text channels!")
+
+            if not ctx.channel.permissions_for(ctx.guild.me).ban_members and sync_bans:
+                sync_bans = False
+                await ctx.send(
+                    "Since the Ban Members permission is not granted to the bridge, "
+                    "we won't be able to sync bans! Proceed with caution!"
+                )
+
+            await ctx.send("Waiting for confirmation...")
+            confirmed = await self.confirm(
+                ctx,
+                owner,
+                "Link group request",
+                f"There is a request to join the link group `{group[0]}` "
+                f"from #{ctx.channel.name} (server: {ctx.guild.name})",
+            )
+            if not confirmed:
+                return await ctx.send("The other side did not confirm this activity")
+
+            new_webhooks, peer_webhooks = await self.prepare_webhooks(ctx.channel)
+            async with self.database.transaction() as database:
+                await database.execute(
+                    "DELETE FROM fail2ban WHERE gid=? AND target_gid=?",
+                    (ctx.guild.id, group[2]),
+                )
+                await database.executemany(
+                    "INSERT INTO webhooks_urls VALUES (?, ?, ?)", new_webhooks
+                )
+                await database.execute(
+                    "INSERT INTO link_group_members VALUES (?, ?, ?, ?)",
+                    (group_id, ctx.channel.id, ctx.guild.id, sync_bans),
+                )
+            self.links.add_member(group_id, ctx.channel.id, ctx.guild.id, sync_bans)
+            for peer, url in peer_webhooks:
+                self.channels.put(peer.id, peer.guild.id, url)
+            await self.links_changed()
+            await ctx.send(f"Successfully joined the link group `{group[0]}`!")
+        else:
+            await ctx.send("You don't have permission to do that!")
+
+    @commands.command()
+    async def leavegroup(self, ctx: commands.Context, group_id: int):
+        """
+        Take this channel out of a link group, the group goes away with its last member
+
+        If this channel owns the group, the member that joined first takes it over.
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            if group_id not in self.links.groups_of(ctx.channel.id):
+                return await ctx.send("This channel is not in that group!")
+
+            group = await self.database.fetchone(
+                "SELECT owner FROM link_groups WHERE id=?", (group_id,)
+            )
+            async with self.database.transaction() as database:
+                await database.execute(
+                    "DELETE FROM link_group_members WHERE group_id=? AND channel=?",
+                    (group_id, ctx.channel.id),
+                )
+                await self.prune_groups(database)
+            heir = None
+            if group is not None and group[0] == ctx.channel.id:
+                heir = await self.database.fetchone(
+                    "SELECT owner FROM link_groups WHERE id=?", (group_id,)
+                )
+            self.links.remove_member(group_id, ctx.channel.id)
+            await self.links_changed()
+            if heir is not None:
+                return await ctx.send(f"Successfully left the group! <#{heir[0]}> now owns it.")
+            await ctx.send("Successfully left the group!")
+
+    @commands.command()
+    async def unlink(self, ctx: commands.Context, channel: int):
+        """
+        Unlink a channel from the current channel
+        """
+        unlink_candidate = []
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            candidate = await self.database.fetchone(
+                "SELECT * FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
+                (ctx.channel.id, channel, channel, ctx.channel.id),
+            )
+            if candidate is not None:
+                unlink_candidate.append(candidate)
+
+            if len(unlink_candidate) == 0:
+                return await ctx.send("You are not linked!")
+
+            deleted_webhooks = []
+            for unlink in unlink_candidate:
+                if unlink is None:
+                    continue
+                target = self.client.get_channel(unlink[1])
+                if target is None:
+                    continue
+                record = self.channels.pop(target.id)
+                if record is None:
+                    continue
+                self.webhooks.pop(target.id)
+                webhook = discord.Webhook.from_url(
+                    record.webhook_url, session=self.get_session()
+                )
+                await webhook.delete()
+                deleted_webhooks.append((target.id,))
+
+            async with self.database.transaction() as database:
+                await database.execute(
+                    "DELETE FROM intercom WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)",
+                    (ctx.channel.id, channel, channel, ctx.channel.id),
+                )
+                await database.executemany(
+                    "DELETE FROM webhooks_urls WHERE id=?", deleted_webhooks
+                )
+            self.links.remove(ctx.channel.id, channel)
+            await self.links_changed()
+            await ctx.send("Successfully unlinked!")
+
+    @commands.command()
+    async def togglelink(self, ctx, channel: int):
+        """
+        Change the state of the link between channels (toggle active bit)
+        """
+        toggle_candidate = []
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            candidate = await self.database.fetchone(
+                "SELECT * FROM intercom WHERE peer1=? AND peer2=?",
+                (ctx.channel.id, channel),
+            )
+            if candidate is not None:
+                toggle_candidate.append(candidate)
+            candidate = await self.database.fetchone(
+                "SELECT * FROM intercom WHERE peer1=? AND peer2=?",
+                (channel, ctx.channel.id),
+            )
+            if candidate is not None:
+                toggle_candidate.append(candidate)
+
+            if len(toggle_candidate) == 0:
+                return await ctx.send("You are not linked!")
+
+            async with self.database.transaction() as database:
+                await database.execute(
+                    "UPDATE intercom SET active=? WHERE peer1=? AND peer2=?",
+                    (1 - toggle_candidate[0][5], ctx.channel.id, channel),
+                )
+                await database.execute(
+                    "UPDATE intercom SET active=? WHERE peer1=? AND peer2=?",
+                    (1 - toggle_candidate[0][5], channel, ctx.channel.id),
+                )
+            self.links.set_active(ctx.channel.id, channel, 1 - toggle_candidate[0][5])
+            await self.links_changed()
+            await ctx.send("Successfully toggled!")
+
+    @commands.command()
+    async def togglecoalesce(self, ctx, channel: int):
+        """
+        Merge bursts of short messages into fewer posts on the link between channels
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            candidate = await self.database.fetchone(
+                """
+                SELECT coalesce_messages FROM intercom
+                WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)
+                """,
+                (ctx.channel.id, channel, channel, ctx.channel.id),
+            )
+            if candidate is None:
+                return await ctx.send("You are not linked!")
+
+            async with self.database.transaction() as database:
+                await database.execute(
+                    """
+                    UPDATE intercom SET coalesce_messages=?
+                    WHERE (peer1=? AND peer2=?) OR (peer1=? AND peer2=?)
+                    """,
+                    (1 - candidate[0], ctx.channel.id, channel, channel, ctx.channel.id),
+                )
+            self.links.set_coalesce(ctx.channel.id, channel, 1 - candidate[0])
+            await self.links_changed()
+            await ctx.send("Successfully toggled!")
+
+    @commands.command()
+    async def listlinks(self, ctx, *, args: str = ""):
+        """
+        List all the channels that are linked to this channel (--guild <id> to filter)
+        """
+        guild_filter = None
+        words = args.split()
+        if words:
+            if len(words) != 2 or words[0] != "--guild" or not words[1].isdigit():
+                return await ctx.send("Usage: `$linktool.listlinks [--guild <id>]`")
+            guild_filter = int(words[1])
+
+        def describe(channel_id, guild_id):
+            target = self.client.get_channel(channel_id)
+            if target is None:
+                return f"`{channel_id}@{guild_id}` (not visible to the bot)"
+            return f"`#{target.name}` (`{target.id}@{target.guild.name}`)"
+
+        lines = []
+        for link in self.links.links_of(ctx.channel.id):
+            peer = link.peer_of(ctx.channel.id)
+            if guild_filter is not None and peer.guild_id != guild_filter:
+                continue
+            lines.append(
+                f"↔️ {describe(peer.channel_id, peer.guild_id)}: "
+                f"{'active' if link.active else 'paused'}, "
+                f"bans {'synced' if link.sync_bans else 'not synced'}"
+                + (", coalescing" if link.coalesce else "")
+            )
+        for group_id in sorted(self.links.groups_of(ctx.channel.id)):
+            for peer in self.links.members(group_id):
+                if peer.channel_id == ctx.channel.id:
+                    continue
+                if guild_filter is not None and peer.guild_id != guild_filter:
+                    continue
+                lines.append(
+                    f"👥 `{group_id}` {describe(peer.channel_id, peer.guild_id)}: "
+                    f"bans {'synced' if peer.sync_bans else 'not synced'}"
+                )
+        if len(lines) == 0:
+            return await ctx.send("You are not linked!")
+
+        pages = [
+            discord.Embed(
+                title=f"Links of #{ctx.channel.name}",
+                description="\n".join(lines[start:start + LINKS_PER_PAGE]),
+                color=0x00FF00,
+            )
+            for start in range(0, len(lines), LINKS_PER_PAGE)
+        ]
+        for number, page in enumerate(pages, start=1):
+            page.set_footer(text=f"Page {number}/{len(pages)}, {len(lines)} links")
+
+        # As many pages per message as Discord allows (10 embeds, 6000 characters)
+        batch = []
+        size = 0
+        for page in pages:
+            if batch and (len(batch) == 10 or size + len(page) > 6000):
+                await ctx.send(embeds=batch)
+                batch = []
+                size = 0
+            batch.append(page)
+            size += len(page)
+        await ctx.send(embeds=batch)
+
+    @commands.command()
+    async def toggle_ban_sync(self, ctx):
+        """
+        Toggle the ban sync for this channel
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            # Check if we have the Ban User permission (needed to sync bans)
+            if not ctx.channel.permissions_for(ctx.guild.me).ban_members:
+                return await ctx.send(
+                    "The Ban Members permission is necessary to access the ban list!"
+                )
+            current = await self.database.fetchone(
+                """
+                SELECT sync_bans FROM intercom WHERE peer1=? OR peer2=?
+                UNION ALL SELECT sync_bans FROM link_group_members WHERE channel=?
+                LIMIT 1
+                """,
+                (ctx.channel.id, ctx.channel.id, ctx.channel.id),
+            )
+            if current is None:
+                return await ctx.send("You are not linked!")
+
+            async with self.database.transaction() as database:
+                await database.execute(
+                    "UPDATE intercom SET sync_bans=? WHERE peer1=? OR peer2=?",
+                    (1 - current[0], ctx.channel.id, ctx.channel.id),
+                )
+                await database.execute(
+                    "UPDATE link_group_members SET sync_bans=? WHERE channel=?",
+                    (1 - current[0], ctx.channel.id),
+                )
+            self.links.set_sync_bans(ctx.channel.id, 1 - current[0])
+            await self.links_changed()
+            await ctx.send("Successfully toggled!")
+
+    @commands.command()
+    async def toggle_silent(self, ctx, guild_id: int):
+        """
+        Disallow another server from sending link requests to this server
+        """
+        if ctx.channel.permissions_for(ctx.author).manage_channels:
+            async with self.database.transaction() as database:
+                cursor = await database.execute(
+                    "DELETE FROM silent_list WHERE gid=? AND silent_gid=?",
+                    (ctx.guild.id, guild_id),
+                )
+                silenced = cursor.rowcount == 0
+                if silenced:
+                    await database.execute(
+                        "INSERT INTO silent_list (gid, silent_gid) VALUES (?, ?)",
+                        (ctx.guild.id, guild_id),
+                    )
+            if silenced:
+                await ctx.send(f"Successfully silenced `{guild_id}`!")
+            else:
+                await ctx.send(f"Successfully unsilenced `{guild_id}`!")
@@ -0,0 +1,246 @@
+"""
+In-memory routing table mirroring the intercom and link_group_members tables
+"""
+
+import itertools
+from typing import NamedTuple
+
+
+class Peer(NamedTuple):
+    """
+    The far end of a link, as seen from one of its channels
+    """
+    channel_id: int
+    guild_id: int
+    sync_bans: bool
+    coalesce: bool = False
+
+
+class Link:
+    """
+    A single row of the intercom table
+    """
+    __slots__ = (
+        "peer1", "peer2", "peer1_gid", "peer2_gid", "active", "sync_bans", "coalesce"
+    )
+
+    def __init__(self, row):
+        self.peer1, self.peer2, self.peer1_gid, self.peer2_gid = row[:4]
+        self.active = bool(row[4])
+        self.sync_bans = bool(row[5])
+        self.coalesce = len(row) > 6 and bool(row[6])
+
+    def peer_of(self, channel_id: int) -> Peer:
+        """
+        Get the other end of this link
+        """
+        if channel_id == self.peer1:
+            return Peer(self.peer2, self.peer2_gid, self.sync_bans, self.coalesce)
+        return Peer(self.peer1, self.peer1_gid, self.sync_bans, self.coalesce)
+
+
+class LinkIndex:
+    """
+    Channel id -> active peers, kept in sync with the database by the Cog
+
+    Pairwise links are kept as ready-made routes per channel. Link groups are kept
+    once, as their members, so a group of K channels takes K entries rather than K².
+    """
+
+    def __init__(self):
+        # channel id -> {peer channel id: Link}
+        self._links = {}
+        # channel id -> tuple of active Peers, what on_message reads
+        self._routes = {}
+        # group id -> {channel id: Peer}
+        self._groups = {}
+        # channel id -> set of group ids
+        self._member_of = {}
+
+    def load(self, rows, members=()):
+        """
+        Rebuild the index from intercom rows, see add(),
+        and link_group_members rows, see add_member()
+        """
+        self._links.clear()
+        self._routes.clear()
+        self._groups.clear()
+        self._member_of.clear()
+        for row in rows:
+            self.add(row)
+        for member in members:
+            self.add_member(*member)
+
+    def targets(self, channel_id: int) -> tuple:
+        """
+        Get the active peers of a channel (empty if it is not linked), each channel once
+        """
+        routes = self._routes.get(channel_id, ())
+        groups = self._member_of.get(channel_id)
+        if not groups:
+            return routes
+
+        # Pairwise links come first, their settings win over the groups'
+        seen = {channel_id}
+        targets = []
+        for peer in itertools.chain(
+            routes, *(self._groups[group_id].values() for group_id in groups)
+        ):
+            if peer.channel_id not in seen:
+                seen.add(peer.channel_id)
+                targets.append(peer)
+        return tuple(targets)
+
+    def groups_of(self, channel_id: int) -> set:
+        """
+        Get the ids of the groups a channel is a member of
+        """
+        return set(self._member_of.get(channel_id, ()))
+
+    def members(self, group_id: int) -> list:
+        """
+        Get the members of a group, as Peers
+        """
+        return list(self._groups.get(group_id, {}).values())
+
+    def links_of(self, channel_id: int) -> list:
+        """
+        Get every link (active or not) of a channel
+        """
+        return list(self._links.get(channel_id, {}).values())
+
+    def ban_synced_guilds(self) -> set:
+        """
+        Get the guilds that are the target of at least one active, ban-synced link
+        """
+        synced = {
+            peer.guild_id
+            for routes in self._routes.values()
+            for peer in routes
+            if peer.sync_bans
+        }
+        # Only groups with another member can send anything to a member
+        synced.update(
+            peer.guild_id
+            for members in self._groups.values()
+            if len(members) > 1
+            for peer in members.values()
+            if peer.sync_bans
+        )
+        return synced
+
+    def add(self, row):
+        """
+        Register a (peer1, peer2, peer1_gid, peer2_gid, active, sync_bans[, coalesce]) link
+        """
+        link = Link(row)
+        self._links.setdefault(link.peer1, {})[link.peer2] = link
+        self._links.setdefault(link.peer2, {})[link.peer1] = link
+        self._rebuild(link.peer1, link.peer2)
+
+    def add_member(self, group_id: int, channel_id: int, guild_id: int, sync_bans: bool):
+        """
+        Register a (group_id, channel, gid, sync_bans) group membership
+        """
+        self._groups.setdefault(group_id, {})[channel_id] = Peer(
+            channel_id, guild_id, bool(sync_bans)
+        )
+        self._member_of.setdefault(channel_id, set()).add(group_id)
+
+    def remove_member(self, group_id: int, channel_id: int):
+        """
+        Take a channel out of a group, forgetting the group once empty
+        """
+        members = self._groups.get(group_id)
+        if members is not None:
+            members.pop(channel_id, None)
+            if not members:
+                del self._groups[group_id]
+        groups = self._member_of.get(channel_id)
+        if groups is not None:
+            groups.discard(group_id)
+            if not groups:
+                del self._member_of[channel_id]
+
+    def remove(self, peer1: int, peer2: int):
+        """
+        Forget the link between two channels
+        """
+        self._links.get(peer1, {}).pop(peer2, None)
+        self._links.get(peer2, {}).pop(peer1, None)
+        self._rebuild(peer1, peer2)
+
+    def set_active(self, peer1: int, peer2: int, active: bool):
+        """
+        Change the active bit of the link between two channels
+        """
+        link = self._links.get(peer1, {}).get(peer2)
+        if link is not None:
+            link.active = bool(active)
+            self._rebuild(peer1, peer2)
+
+    def set_coalesce(self, peer1: int, peer2: int, coalesce: bool):
+        """
+        Change the coalescing bit of the link between two channels
+        """
+        link = self._links.get(peer1, {}).get(peer2)
+        if link is not None:
+            link.coalesce = bool(coalesce)
+            self._rebuild(peer1, peer2)
+
+    def set_sync_bans(self, channel_id: int, sync_bans: bool):
+        """
+        Change the sync_bans bit of every link of a channel
+        """
+        peers = list(self._links.get(channel_id, {}))
+        for link in self._links.get(channel_id, {}).values():
+            link.sync_bans = bool(sync_bans)
+        self._rebuild(channel_id, *peers)
+        for group_id in self._member_of.get(channel_id, ()):
+            members = self._groups[group_id]
+            members[channel_id] = members[channel_id]._replace(sync_bans=bool(sync_bans))
+
+    def drop_channel(self, channel_id: int):
+        """
+        Forget every link of a channel
+        """
+        for peer in list(self._links.get(channel_id, {})):
+            self.remove(channel_id, peer)
+        for group_id in self.groups_of(channel_id):
+            self.remove_member(group_id, channel_id)
+
+    def drop_guild(self, guild_id: int):
+        """
+        Forget every link that has an end in a guild
+        """
+        doomed = {
+            (link.peer1, link.peer2)
+            for links in self._links.values()
+            for link in links.values()
+            if guild_id in (link.peer1_gid, link.peer2_gid)
+        }
+        for peer1, peer2 in doomed:
+            self.remove(peer1, peer2)
+        members = [
+            (group_id, peer.channel_id)
+            for group_id, members in self._groups.items()
+            for peer in members.values()
+            if peer.guild_id == guild_id
+        ]
+        for group_id, channel_id in members:
+            self.remove_member(group_id, channel_id)
+
+    def _rebuild(self, *channel_ids):
+        for channel_id in channel_ids:
+            links = self._links.get(channel_id)
+            if not links:
+                self._links.pop(channel_id, None)
+                self._routes.pop(channel_id, None)
+                continue
+            routes = tuple(
+                link.peer_of(channel_id) for link in links.values() if link.active
+            )
+            if routes:
+                self._routes[channel_id] = routes
+            else:
+                self._routes.pop(channel_id, None)
@@ -0,0 +1,100 @@
+"""
+Logging through a queue, formatted and written by a background thread
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Structured fields a record may carry (through extra=), in the order they are printed
+FIELDS = ("source", "target", "guild", "latency", "outcome")
+
+# The running QueueListener, if any
+_STATE = {"listener": None}
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are, leaving all formatting to the listener thread
+
+    The arguments of a record are formatted later, so they must not change after
+    the log call (the Cog only logs ids, numbers and strings).
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Plain text line followed by the structured fields of the record as key=value
+    """
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [
+            f"{name}={getattr(record, name)}" for name in FIELDS if hasattr(record, name)
+        ]
+        if fields:
+            line = f"{line} {' '.join(fields)}"
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record, with the structured fields as keys
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name in FIELDS:
+            if hasattr(record, name):
+                entry[name] = getattr(record, name)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(level: str = "INFO", style: str = "text"):
+    """
+    Route every log record through a queue to a stdout writer running in its own thread
+    """
+    if _STATE["listener"] is not None:
+        return
+
+    if style == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = StructuredFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(_DeferredQueueHandler(records))
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    _STATE["listener"] = listener
+    # Flush what is still queued when the bot exits
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Write out the queued records and stop the writer thread
+    """
+    listener = _STATE["listener"]
+    if listener is not None:
+        listener.stop()
+        _STATE["listener"] = None
@@ -2,12 +2,21 @@
 Main script to launch the bot
 """
 import configparser
+import logging
 import os
+import secrets
 import sys
+import time
 
 import discord
 from discord.ext import commands
 
+import logs
+from sharding import ShardLayout
+
+# When the process started and how long it took to get ready, for deploys
+STARTUP = {"started": time.monotonic()}
+
 # Check if the runtime dir and runtime/config.ini exists, else create them
 if not os.path.isdir("runtime"):
     os.mkdir("runtime")
@@ -16,6 +25,44 @@ if not os.path.isfile("runtime/config.ini"):
     config["Credentials"] = {
         "discord_token": "",
     }
+    config["Intercom"] = {
+        "relay_concurrency": "8",
+        "webhook_pool_size": "256",
+        "attachment_spill_size": "8388608",
+        "ban_sync_workers": "4",
+        "ban_snapshot_max_age": "86400",
+        "queue_depth": "100",
+        "queue_drop_policy": "oldest",
+        "delivery_retries": "3",
+        "webhook_rate": "5",
+        "webhook_rate_period": "2",
+        "webhook_failure_threshold": "5",
+        "webhook_cooldown": "60",
+        "journal_flush_interval": "250",
+        "journal_replay_interval": "60",
+        "journal_max_attempts": "5",
+        "relayed_max": "100000",
+        "relayed_ttl": "86400",
+        "relayed_persist": "false",
+        "identity_cache_size": "4096",
+        "coalesce_window": "750",
+    }
+    config["Gateway"] = {
+        "low_footprint": "false",
+    }
+    config["Sharding"] = {
+        "shard_count": "0",
+        "process_count": "1",
+        "process_index": "0",
+        "ipc_host": "127.0.0.1",
+        "ipc_port": "7100",
+        # Every process of a deployment needs the same one
+        "secret": secrets.token_urlsafe(32),
+    }
+    config["Logging"] = {
+        "level": "INFO",
+        "format": "text",
+    }
     with open("runtime/config.ini", "w", encoding="utf-8") as f:
         config.write(f)
     print("Created runtime/config.ini. Please populate your credentials")
@@ -25,15 +72,48 @@ if not os.path.isfile("runtime/config.ini"):
 config = configparser.ConfigParser()
 config.read("runtime/config.ini")
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.bans = True
-
+logs.setup(
+    config.get("Logging", "level", fallback="INFO"),
+    config.get("Logging", "format", fallback="text"),
+)
+logger = logging.getLogger("main")
 
-client = commands.Bot(command_prefix="$linktool.", intents=intents)
+options = {}
+if config.getboolean("Gateway", "low_footprint", fallback=False):
+    # Only what the Intercom needs: guilds and channels, guild messages
+    # (with their content) and bans. No member list, no member chunking at startup
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.bans = True
+    options["member_cache_flags"] = discord.MemberCacheFlags.none()
+    options["chunk_guilds_at_startup"] = False
+else:
+    # Request the Message Content Privileged Intents
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    intents.bans = True
 
-# Request the Message Content Privileged Intents
+shard_count = config.getint("Sharding", "shard_count", fallback=0)
+if shard_count > 0:
+    # This process only runs its own range of the shards
+    layout = ShardLayout(
+        shard_count,
+        config.getint("Sharding", "process_count", fallback=1),
+        config.getint("Sharding", "process_index", fallback=0),
+    )
+    logger.info("Running shards %s of %d", layout.shard_ids, shard_count)
+    client = commands.AutoShardedBot(
+        command_prefix="$linktool.",
+        intents=intents,
+        shard_count=shard_count,
+        shard_ids=layout.shard_ids,
+        **options,
+    )
+else:
+    client = commands.Bot(command_prefix="$linktool.", intents=intents, **options)
 
 
 @client.event
@@ -41,10 +121,13 @@ async def on_ready():
     """
     Run when the bot is ready
     """
-    print("Logged in as")
-    print(client.user.name)
-    print(client.user.id)
-    print("------")
+    logger.info("Logged in as %s (%s)", client.user.name, client.user.id)
+    # on_ready fires again after a resume, only the first one is startup
+    if "ready_after" not in STARTUP:
+        STARTUP["ready_after"] = time.monotonic() - STARTUP["started"]
+        logger.info(
+            "Ready in %.1fs with %d guilds", STARTUP["ready_after"], len(client.guilds)
+        )
     await client.change_presence(
         activity=discord.Game(name="aboard the Universal Cereal Bus")
     )
@@ -0,0 +1,252 @@
+"""
+Relay metrics, exposed in the Prometheus text format
+"""
+
+import bisect
+import contextlib
+import time
+
+from aiohttp import web
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """
+        Get the child metric for a set of label values
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        # Unlabelled metrics are their own single child
+        return self.labels()
+
+    def render(self) -> list:
+        """
+        Get the exposition lines of this metric
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in self._children.items():
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        """
+        Increase the counter
+        """
+        self.value += amount
+
+    def render(self, name, labelnames, values) -> list:
+        """
+        Get the exposition lines of this counter
+        """
+        return [f"{name}{_format_labels(labelnames, values)} {self.value}"]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up
+    """
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        """
+        Increase the (unlabelled) counter
+        """
+        self._default().inc(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """
+        Record one observation
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        """
+        Observe how long the body of the with block took
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def render(self, name, labelnames, values) -> list:
+        """
+        Get the exposition lines of this histogram
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, (("le", bound),))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, values, (("le", "+Inf"),))
+        lines.append(f"{name}_bucket{labels} {self.count}")
+        labels = _format_labels(labelnames, values)
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Observations sorted into cumulative buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        """
+        Record one observation on the (unlabelled) histogram
+        """
+        self._default().observe(value)
+
+    def time(self):
+        """
+        Observe how long the body of the with block took on the (unlabelled) histogram
+        """
+        return self._default().time()
+
+
+def render() -> str:
+    """
+    Get every registered metric in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+RELAY_LATENCY = Histogram(
+    "intercom_relay_latency_seconds",
+    "Time from receiving a message to its relay being accepted by a target webhook",
+)
+DB_LOOKUP = Histogram(
+    "intercom_db_lookup_seconds", "Time spent on database reads"
+)
+ATTACHMENT_DOWNLOAD = Histogram(
+    "intercom_attachment_download_seconds",
+    "Time spent downloading the attachments of a relayed message",
+)
+WEBHOOK_SEND = Histogram(
+    "intercom_webhook_send_seconds", "Time spent on each webhook call", ("target",)
+)
+MESSAGES_RELAYED = Counter(
+    "intercom_messages_relayed_total", "Relays accepted by a target webhook"
+)
+MESSAGES_FILTERED = Counter(
+    "intercom_messages_filtered_total", "Messages dropped before any target was resolved"
+)
+MESSAGES_BANNED = Counter(
+    "intercom_messages_banned_total", "Relays skipped because the author is banned in the target"
+)
+MESSAGES_FAILED = Counter(
+    "intercom_messages_failed_total", "Relays that failed or were dropped", ("reason",)
+)
+DELIVERY_RETRIES = Counter(
+    "intercom_delivery_retries_total", "Webhook calls tried again after a retryable failure"
+)
+WEBHOOKS_RECREATED = Counter(
+    "intercom_webhooks_recreated_total", "Target webhooks recreated after being deleted"
+)
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP at /metrics
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        """
+        Start listening, if not already
+        """
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+
+    async def stop(self):
+        """
+        Stop listening
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, _request):
+        """
+        Answer a scrape
+        """
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,118 @@
+"""
+Which webhook messages each relayed source message became
+"""
+
+import time
+from collections import OrderedDict
+
+# Discord's epoch, in milliseconds since the Unix epoch
+DISCORD_EPOCH = 1420070400000
+
+
+def time_snowflake(timestamp: float) -> int:
+    """
+    Get the lowest Discord id created at a time, in seconds since the Unix epoch
+    """
+    return int(timestamp * 1000 - DISCORD_EPOCH) << 22
+
+
+class RelayedMessages:
+    """
+    Source message id -> list of (target channel id, webhook message id)
+
+    Message ids carry their creation time, so entries older than ttl seconds are
+    recognised from their key alone and nothing else is stored per message.
+    At most maxsize source messages are kept, the least recently relayed go first.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 86400, persist: bool = False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist = persist
+        self._copies = OrderedDict()
+        # (source, target, message) rows added since the last save
+        self._dirty = []
+
+    def expect(self, source_id: int):
+        """
+        Record that a source message is being relayed, before any copy is posted
+        """
+        if source_id not in self._copies:
+            self._copies[source_id] = []
+            self.expire()
+
+    def add(self, source_id: int, target_id: int, message_id: int):
+        """
+        Record the copy of a source message posted in a target channel
+        """
+        copies = self._copies.get(source_id)
+        if copies is None:
+            copies = self._copies[source_id] = []
+            self.expire()
+        copies.append((target_id, message_id))
+        if self.persist:
+            self._dirty.append((source_id, target_id, message_id))
+
+    def get(self, source_id: int, target_id: int):
+        """
+        Get the id of the copy of a source message in a target channel, if still known
+        """
+        for target, message_id in self._copies.get(source_id, ()):
+            if target == target_id:
+                return message_id
+        return None
+
+    def pop(self, source_id: int, target_id: int):
+        """
+        Forget (and get) the copy of a source message in a target channel
+        """
+        copies = self._copies.get(source_id)
+        if copies is None:
+            return None
+        for index, (target, message_id) in enumerate(copies):
+            if target == target_id:
+                del copies[index]
+                if not copies:
+                    del self._copies[source_id]
+                return message_id
+        return None
+
+    def expire(self):
+        """
+        Drop the entries past maxsize or older than ttl
+        """
+        while len(self._copies) > self.maxsize:
+            self._copies.popitem(last=False)
+        oldest = self.cutoff()
+        while self._copies:
+            source_id = next(iter(self._copies))
+            if source_id >= oldest:
+                break
+            del self._copies[source_id]
+
+    def cutoff(self) -> int:
+        """
+        Get the lowest source message id still worth keeping
+        """
+        return time_snowflake(time.time() - self.ttl)
+
+    def load(self, rows):
+        """
+        Restore (source, target, message) rows saved earlier, oldest first
+        """
+        for source_id, target_id, message_id in rows:
+            self._copies.setdefault(source_id, []).append((target_id, message_id))
+        self.expire()
+
+    def take_dirty(self) -> list:
+        """
+        Get the rows added since the last call
+        """
+        rows, self._dirty = self._dirty, []
+        return rows
+
+    def __contains__(self, source_id):
+        return source_id in self._copies
+
+    def __len__(self):
+        return len(self._copies)
@@ -0,0 +1,605 @@
+"""
+The relay pipeline of the Intercom: filtering, delivery, replays, edits and deletions
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+import aiohttp
+import discord
+from discord.ext import commands, tasks
+
+import attachments
+import metrics
+from delivery import Delivery
+from health import WebhookUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+class RelayMixin:
+    """
+    Relaying messages to the linked channels, mixed into the Intercom cog
+    """
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared HTTP session, (re)creating it if needed
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(keepalive_timeout=60)
+            )
+            # Pooled webhooks are bound to the old session
+            self.webhooks.clear()
+        return self.session
+
+    async def get_webhook(self, target) -> tuple:
+        """
+        Get the (webhook, url) of a channel from the pool, the channel cache or by creating it
+        """
+        pooled = self.webhooks.get(target.id)
+        if pooled is not None:
+            return pooled
+
+        record = self.channels.get(target.id)
+        if record is None:
+            return await self.health.repair(target.id, lambda: self.create_webhook(target))
+
+        # The URL stays with the webhook, the channel record may be reloaded meanwhile
+        pooled = (
+            discord.Webhook.from_url(record.webhook_url, session=self.get_session()),
+            record.webhook_url,
+        )
+        self.webhooks.put(target.id, pooled)
+        return pooled
+
+    async def create_webhook(self, target) -> tuple:
+        """
+        Create a new webhook for a channel, recording it in place of any previous one,
+        get its (webhook, url)
+        """
+        created = await target.create_webhook(name=f"Intercom_{target.name}")
+        async with self.database.transaction() as database:
+            await database.execute(
+                "INSERT OR REPLACE INTO webhooks_urls VALUES (?, ?, ?)",
+                (target.id, created.url, target.guild.id),
+            )
+        self.channels.put(target.id, target.guild.id, created.url)
+        pooled = (
+            discord.Webhook.from_url(created.url, session=self.get_session()), created.url
+        )
+        self.webhooks.put(target.id, pooled)
+        return pooled
+
+    async def replace_webhook(self, target, stale_url: str) -> tuple:
+        """
+        Get the (webhook, url) replacing the webhook of a channel (at stale_url) that was deleted
+
+        Concurrent deliveries hitting the same deleted webhook share a single recreation.
+        """
+        record = self.channels.get(target.id)
+        if record is not None and record.webhook_url != stale_url:
+            # Someone else already replaced it
+            return await self.get_webhook(target)
+
+        async def recreate():
+            logger.warning("Recreating deleted webhook", extra={"target": target.id})
+            self.webhooks.pop(target.id)
+            pooled = await self.create_webhook(target)
+            metrics.WEBHOOKS_RECREATED.inc()
+            return pooled
+
+        return await self.health.repair(target.id, recreate)
+
+    @tasks.loop(seconds=0.25)
+    async def flush_journal(self):
+        """
+        Task to group-commit the journal changes of the last interval in one transaction
+        """
+        batch = self.journal.take_batch()
+        if not batch:
+            return
+        async with self.database.transaction() as database:
+            for statement, rows in batch:
+                await database.executemany(statement, rows)
+        self.journal.committed(batch)
+
+    @flush_journal.before_loop
+    async def before_flush_journal(self):
+        """
+        Wait for the bot to be ready before flushing the journal
+        """
+        await self.client.wait_until_ready()
+
+    @tasks.loop(seconds=60)
+    async def replay_journal(self):
+        """
+        Task to send again the relays that failed or were cut short by a restart
+        """
+        await self.flush_journal()
+        rows = await self.database.fetchall(
+            """
+            SELECT relay_journal.payload, target, guild, attempts, source, body
+            FROM relay_journal JOIN relay_payloads ON relay_payloads.id = relay_journal.payload
+            """
+        )
+        if self.layout is not None:
+            # The other processes replay the targets they own
+            rows = [row for row in rows if self.layout.is_local(row[2])]
+        groups = collections.defaultdict(list)
+        for entry in self.journal.restore(rows):
+            groups[entry.payload].append(entry)
+        if groups:
+            logger.info("Replaying %d journaled relays", sum(map(len, groups.values())))
+
+        state = self.client._connection  # pylint: disable=protected-access
+        for payload, entries in groups.items():
+            peers = {peer.channel_id: peer for peer in self.links.targets(payload.source_id)}
+            targets = []
+            kept = []
+            for entry in entries:
+                peer = peers.get(entry.target_id)
+                channel = self.client.get_channel(entry.target_id)
+                if peer is None or channel is None:
+                    # Unlinked or gone since
+                    self.journal.discard(entry)
+                else:
+                    targets.append((peer, channel))
+                    kept.append(entry)
+            if len(targets) == 0:
+                continue
+
+            body = payload.body
+            self.relay(
+                payload.source_id,
+                targets,
+                [discord.Attachment(data=data, state=state) for data in body["attachments"]],
+                entries=kept,
+                author=discord.Object(body["author_id"]),
+                message_id=body.get("message_id"),
+                author_id=body["author_id"],
+                content=body["content"],
+                embeds=[discord.Embed.from_dict(embed) for embed in body["embeds"]],
+                username=body["username"],
+                avatar_url=body["avatar_url"],
+                received=None,
+            )
+
+    @replay_journal.before_loop
+    async def before_replay_journal(self):
+        """
+        Wait for the bot to be ready before replaying the journal
+        """
+        await self.client.wait_until_ready()
+
+    @tasks.loop(seconds=30)
+    async def save_relayed(self):
+        """
+        Task to write the newly relayed messages to disk and drop the expired ones
+        """
+        rows = self.relayed.take_dirty()
+        async with self.database.transaction() as database:
+            if rows:
+                await database.executemany(
+                    "INSERT OR REPLACE INTO relayed_messages VALUES (?, ?, ?)", rows
+                )
+            await database.execute(
+                "DELETE FROM relayed_messages WHERE source < ?", (self.relayed.cutoff(),)
+            )
+
+    @save_relayed.before_loop
+    async def before_save_relayed(self):
+        """
+        Wait for the bot to be ready before saving the relayed messages
+        """
+        await self.client.wait_until_ready()
+
+    def relayable(self, content: str, files, embeds) -> bool:
+        """
+        Check if the content of a message may be relayed at all
+        """
+        # Ignore: commands provided by self, discord invites & gifts
+        if (
+            content.startswith(self.client.command_prefix)
+            or content.startswith("https://discord.gg/")
+            or content.startswith("https://discord.com/invite/")
+            or content.startswith("https://discordapp.com/invite/")
+            or content.startswith("https://discord.gift/")
+        ):
+            return False
+
+        # Ignore message if EVERYTHING is empty at this point
+        # (we can't support everything, eg. Stickers)
+        return len(files) != 0 or len(embeds) != 0 or content != ""
+
+    def relay_candidates(self, message: discord.Message) -> tuple:
+        """
+        Cheap synchronous filter, get the linked peers a message may go to (empty to drop it)
+        """
+        # Ignore: self, bots and webhooks
+        if (
+            message.author.bot
+            or message.author == self.client.user
+            or message.webhook_id is not None
+            or not self.relayable(message.content, message.attachments, message.embeds)
+        ):
+            return ()
+
+        return self.links.targets(message.channel.id)
+
+    def resolve_targets(self, source_id: int, peers) -> list:
+        """
+        Get the (peer, channel) pairs of the peers that can actually be reached
+        """
+        def skipped(peer, outcome):
+            return {
+                "source": source_id,
+                "target": peer.channel_id,
+                "guild": peer.guild_id,
+                "outcome": outcome,
+            }
+
+        targets = []
+        for peer in peers:
+            channel = self.client.get_channel(peer.channel_id)
+            if channel is None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Relay skipped", extra=skipped(peer, "unreachable"))
+                continue
+            targets.append((peer, channel))
+        return targets
+
+    async def banned(self, source_id: int, peer, author) -> bool:
+        """
+        Check if the author of a message is banned in a target syncing bans
+        """
+        if not await self.is_user_banned(peer.guild_id, author):
+            return False
+        metrics.MESSAGES_BANNED.inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Relay skipped",
+                extra={
+                    "source": source_id,
+                    "target": peer.channel_id,
+                    "guild": peer.guild_id,
+                    "outcome": "banned",
+                },
+            )
+        return True
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        """
+        Handle messages
+        """
+        received = time.monotonic()
+        peers = self.relay_candidates(message)
+        if len(peers) == 0:
+            metrics.MESSAGES_FILTERED.inc()
+            return
+
+        username, avatar_url = self.identity(message)
+        if self.layout is not None:
+            peers = self.hand_off(message, peers, username, avatar_url)
+
+        # Nothing is awaited before the deliveries are queued, so they keep the order
+        # the messages came in even when checking bans or downloading takes a while
+        targets = self.resolve_targets(message.channel.id, peers)
+        if len(targets) == 0:
+            return
+
+        self.relay(
+            message.channel.id,
+            targets,
+            message.attachments,
+            author=message.author,
+            message_id=message.id,
+            author_id=message.author.id,
+            content=message.content,
+            embeds=list(message.embeds),
+            username=username,
+            avatar_url=avatar_url,
+            received=received,
+        )
+
+    def identity(self, message: discord.Message) -> tuple:
+        """
+        Get the (username, avatar url) the author of a message is relayed with
+        """
+        guilds = self.identities.get(message.author.id)
+        if guilds is None:
+            guilds = {}
+            self.identities.put(message.author.id, guilds)
+        identity = guilds.get(message.guild.id)
+        if identity is None:
+            author = message.author
+            # Webhook usernames are capped at 80 characters, keep the server part whole
+            suffix = f" @ {message.guild.name}"[:40]
+            identity = guilds[message.guild.id] = (
+                author.display_name[:80 - len(suffix)] + suffix,
+                # Falls back to the default avatar for users without one
+                author.display_avatar.url,
+            )
+        return identity
+
+    def relay(
+        self, source_id: int, targets, message_attachments, entries=None, author=None, **message
+    ):
+        """
+        Queue one delivery of a message per (peer, channel) target, right away
+
+        message holds the message_id, author_id, content, embeds, username and avatar_url
+        to post with, and the time.monotonic() the message was received at (None for replays).
+        entries are the journal entries of the targets when replaying, new ones are
+        journaled otherwise. If an author is given, each delivery to a target syncing bans
+        checks it first, from its place in the queue. Targets whose webhook breaker is open
+        get no delivery, their entries stay journaled for a later replay.
+        """
+        if entries is None:
+            entries = self.journal.record(
+                source_id,
+                {
+                    "message_id": message["message_id"],
+                    "author_id": message["author_id"],
+                    "content": message["content"],
+                    "embeds": [embed.to_dict() for embed in message["embeds"]],
+                    "attachments": [attachment.to_dict() for attachment in message_attachments],
+                    "username": message["username"],
+                    "avatar_url": message["avatar_url"],
+                },
+                [(peer.channel_id, peer.guild_id) for peer, _ in targets],
+            )
+
+        queued = []
+        for (peer, channel), entry in zip(targets, entries):
+            if self.health.available(peer.channel_id):
+                queued.append((peer, channel, entry))
+                continue
+            # Left in the journal, replay_journal sends it once the breaker lets calls through
+            self.journal.settle(entry, "interrupted")
+            metrics.MESSAGES_FAILED.labels("unhealthy").inc()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Relay deferred",
+                    extra={
+                        "source": source_id,
+                        "target": peer.channel_id,
+                        "guild": peer.guild_id,
+                        "outcome": "unhealthy",
+                    },
+                )
+        if len(queued) == 0:
+            return
+
+        embeds = message["embeds"]
+        remaining = len(queued)
+        message_id = message["message_id"]
+        if message_id is not None:
+            self.relayed.expect(message_id)
+        download = None
+
+        async def fetch():
+            with metrics.ATTACHMENT_DOWNLOAD.time():
+                return await attachments.download_all(
+                    message_attachments, self.get_session(), self.spill_size
+                )
+
+        def close(future):
+            if not future.cancelled() and future.exception() is None:
+                for attachment in future.result():
+                    attachment.close()
+
+        def release(entry):
+            def settle(outcome):
+                # The buffers go away once every target is done with them
+                nonlocal remaining
+                self.journal.settle(entry, outcome)
+                remaining -= 1
+                if remaining == 0 and download is not None:
+                    download.add_done_callback(close)
+            return settle
+
+        def preparer(peer):
+            async def ready():
+                nonlocal download
+                if author is not None and peer.sync_bans:
+                    if await self.banned(source_id, peer, author):
+                        return False
+                if message_attachments:
+                    # Only now that someone will receive it, download every attachment once,
+                    # each target re-uploads from the shared buffers
+                    if download is None:
+                        download = asyncio.ensure_future(fetch())
+                    await asyncio.shield(download)
+                return True
+            return ready
+
+        def sender(target):
+            async def post(webhook, content):
+                shared = download.result() if download is not None else ()
+                copy = await webhook.send(
+                    content=content,
+                    files=[attachment.to_file() for attachment in shared],
+                    embeds=embeds,
+                    avatar_url=message["avatar_url"],
+                    username=message["username"],
+                    wait=True,
+                )
+                # Coalesced posts hold several messages, an edit of one cannot apply to them
+                if message_id is not None and content == message["content"]:
+                    self.relayed.add(message_id, target.id, copy.id)
+
+            async def send(content):
+                # Deliveries queued before the breaker opened, or while its single
+                # probe call is out, fail without a call
+                if not self.health.allow(target.id):
+                    raise WebhookUnavailable(target.id)
+                healthy = None
+                try:
+                    webhook, url = await self.get_webhook(target)
+                    try:
+                        await post(webhook, content)
+                    except discord.errors.NotFound as exception:
+                        if exception.code != 10015:
+                            raise
+                        # Unknown Webhook: it was deleted, make a new one and try again
+                        webhook, _ = await self.replace_webhook(target, url)
+                        await post(webhook, content)
+                    healthy = True
+                except discord.errors.HTTPException as exception:
+                    # Rate limits say nothing about the health of the webhook
+                    if exception.status != 429:
+                        healthy = False
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                    healthy = False
+                    raise
+                finally:
+                    if healthy is None:
+                        self.health.abandon(target.id)
+                    elif healthy:
+                        self.health.succeeded(target.id)
+                    else:
+                        self.health.failed(target.id)
+            return send
+
+        # Plain text from one author may be merged with its next lines on coalescing links
+        text_only = len(message_attachments) == 0 and len(embeds) == 0
+        merge_key = (source_id, message["author_id"])
+
+        # Hand every target to its own queue, a slow or failing one holds up no other
+        for peer, channel, entry in queued:
+            self.dispatcher.submit(
+                Delivery(
+                    source_id,
+                    peer.channel_id,
+                    sender(channel),
+                    release(entry),
+                    content=message["content"],
+                    merge_key=merge_key if peer.coalesce and text_only else None,
+                    received=message["received"],
+                    guild_id=peer.guild_id,
+                    ready=preparer(peer),
+                )
+            )
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        """
+        Edit the copies of an edited message, or delete them if it may not be relayed anymore
+        """
+        # Embed-only updates (such as link previews) may carry no content
+        content = payload.data.get("content")
+        if content is None or payload.data.get("webhook_id") is not None:
+            return
+        # Updates leaving the content as it was (link previews unfurling, pins) are no edits,
+        # without the old message at hand a message never edited has no edited_timestamp
+        if payload.cached_message is not None:
+            if payload.cached_message.content == content:
+                return
+        elif payload.data.get("edited_timestamp") is None:
+            return
+        if not self.relayable(
+            content, payload.data.get("attachments", ()), payload.data.get("embeds", ())
+        ):
+            content = None
+        self.update_relays(payload.channel_id, payload.message_id, content)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """
+        Delete the copies of a deleted message
+        """
+        self.update_relays(payload.channel_id, payload.message_id, None)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """
+        Delete the copies of messages deleted in bulk
+        """
+        for message_id in payload.message_ids:
+            self.update_relays(payload.channel_id, message_id, None)
+
+    def update_relays(self, source_id: int, message_id: int, content, peers=None):
+        """
+        Queue the edit of the copies of a message to content, or their deletion if None
+
+        The updates go through the same queues as the relays, so they always run after
+        the copy they apply to was posted.
+        """
+        if message_id < self.relayed.cutoff():
+            return
+        if peers is None:
+            peers = self.links.targets(source_id)
+            if self.layout is not None and peers:
+                peers, remote = self.split_peers(peers)
+                for process, group in remote.items():
+                    payload = {
+                        "source": source_id,
+                        "message": message_id,
+                        "content": content,
+                        "peers": group,
+                    }
+                    self.spawn_handoff(process, payload, "update")
+        # Only messages this process relayed (or is relaying) have copies
+        if message_id not in self.relayed:
+            return
+
+        def updater(peer):
+            async def send(_content):
+                copy_id = self.relayed.get(message_id, peer.channel_id)
+                channel = self.client.get_channel(peer.channel_id)
+                if copy_id is None or channel is None:
+                    return
+                webhook, _ = await self.get_webhook(channel)
+                try:
+                    if content is None:
+                        await webhook.delete_message(copy_id)
+                    else:
+                        await webhook.edit_message(copy_id, content=content)
+                except discord.errors.NotFound:
+                    # The copy was deleted on the other side
+                    pass
+                if content is None:
+                    self.relayed.pop(message_id, peer.channel_id)
+            return send
+
+        for peer in peers:
+            self.dispatcher.submit(
+                Delivery(
+                    source_id,
+                    peer.channel_id,
+                    updater(peer),
+                    content=content or "",
+                    guild_id=peer.guild_id,
+                    update=True,
+                )
+            )
+
+    @commands.Cog.listener()
+    async def on_user_update(self, _before, after):
+        """
+        Forget how a user was relayed after a name or avatar change
+        """
+        self.identities.pop(after.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, _before, after):
+        """
+        Forget how a member was relayed after a nickname or server avatar change
+        """
+        guilds = self.identities.get(after.id)
+        if guilds is not None:
+            guilds.pop(after.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before, after):
+        """
+        Forget the relayed identities carrying the old name of a renamed server
+        """
+        if before.name != after.name:
+            self.identities.clear()
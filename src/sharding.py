@@ -0,0 +1,152 @@
+"""
+Running the bot as several processes, each owning a range of shards
+"""
+
+import asyncio
+import hmac
+import logging
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Header carrying the secret shared by the processes of one deployment
+SECRET_HEADER = "X-Intercom-Secret"
+
+
+class ShardLayout:
+    """
+    Which process owns which shards (and so which guilds)
+
+    The shard_count shards are split into process_count contiguous ranges,
+    process number process_index owns one of them.
+    """
+
+    def __init__(self, shard_count: int, process_count: int = 1, process_index: int = 0):
+        self.shard_count = shard_count
+        self.process_count = process_count
+        self.process_index = process_index
+        # Shards per process, the last one may own fewer
+        self.per_process = -(-shard_count // process_count)
+
+    @property
+    def shard_ids(self) -> list:
+        """
+        Get the shards this process owns
+        """
+        start = self.process_index * self.per_process
+        return list(range(start, min(start + self.per_process, self.shard_count)))
+
+    def shard_of(self, guild_id: int) -> int:
+        """
+        Get the shard a guild is on (Discord's formula)
+        """
+        return (guild_id >> 22) % self.shard_count
+
+    def process_of(self, guild_id: int) -> int:
+        """
+        Get the process owning a guild
+        """
+        return self.shard_of(guild_id) // self.per_process
+
+    def is_local(self, guild_id: int) -> bool:
+        """
+        Check if a guild is owned by this process
+        """
+        return self.process_of(guild_id) == self.process_index
+
+
+class Handoff:
+    """
+    JSON over HTTP on localhost between the processes of one deployment
+
+    Process number i listens on base_port + i, handlers are registered per kind of
+    message and answer with a JSON object. Every message carries the shared secret,
+    the ones that do not are turned away.
+    """
+
+    def __init__(
+        self, layout: ShardLayout, secret: str, host: str = "127.0.0.1", base_port: int = 7100
+    ):
+        if not secret:
+            raise ValueError("The processes need a shared secret to hand relays over")
+        self.layout = layout
+        self.secret = secret
+        self.host = host
+        self.base_port = base_port
+        self.handlers = {}
+        self._runner = None
+        self._session = None
+
+    def on(self, kind: str, handler):
+        """
+        Register the async handler of a kind of message, given the payload, returning a dict
+        """
+        self.handlers[kind] = handler
+
+    async def start(self):
+        """
+        Start listening, if not already
+        """
+        if self._runner is not None:
+            return
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/{kind}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(
+            runner, self.host, self.base_port + self.layout.process_index
+        ).start()
+        self._runner = runner
+
+    async def stop(self):
+        """
+        Stop listening and close the outgoing session
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def handle(self, request: web.Request):
+        """
+        Answer a message from another process
+        """
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()
+        ):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        handler = self.handlers.get(request.match_info["kind"])
+        if handler is None:
+            return web.json_response({"error": "unknown kind"}, status=404)
+        return web.json_response(await handler(await request.json()) or {})
+
+    async def send(self, process: int, kind: str, payload: dict, timeout: float = 10) -> dict:
+        """
+        Send a message to another process and get its answer
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        async with self._session.post(
+            f"http://{self.host}:{self.base_port + process}/{kind}",
+            json=payload,
+            headers={SECRET_HEADER: self.secret},
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def broadcast(self, kind: str, payload: dict):
+        """
+        Send a message to every other process, logging the ones that cannot be reached
+        """
+        for process in range(self.layout.process_count):
+            if process == self.layout.process_index:
+                continue
+            try:
+                await self.send(process, kind, payload)
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as exception:
+                logger.warning("Could not reach process %d: %r", process, exception)